@@ -2,17 +2,20 @@
 
 interface ApiMessage {
     type: string;
-    payload?: AuthenticatePayload | RoomConfigPayload[] | ScheduleConfigPayload[] | LinkConfigPayload[] | TimezonesConfigPayload | TilesetPayload | UserPayload | EnterJitsiRoomPayload | OpenJitsiRoomPayload | JitsiRoomUsersPayload | UpdateProfilePlayload | UpdateAvatarImagePayload | SetAvatarLocationPayload | UpdateAvatarLocationPayload | LeaveMapPayload | BadgeConfigPayload[] | BroadcastMessagePayload | UserMessagePayload | RequestVideoChatPayload;
+    payload?: AuthenticatePayload | RoomConfigPayload[] | ScheduleConfigPayload[] | LinkConfigPayload[] | TimezonesConfigPayload | TilesetPayload | UserPayload | EnterJitsiRoomPayload | OpenJitsiRoomPayload | JitsiRoomUsersPayload | UpdateProfilePlayload | SetAvatarLocationPayload | UpdateAvatarLocationPayload | RoomSnapshotPayload | RoomAtlasPayload | AvatarLocationsPayload | EnterRoomPayload | LeaveMapPayload | BadgeConfigPayload[] | BroadcastMessagePayload | UserMessagePayload | RequestVideoChatPayload | ConfigBundleRequestPayload | ConfigBundlePayload | ConfigBundleNotModifiedPayload;
 }
 
 interface AuthenticatePayload {
     email: string;
     remember: boolean;
     token?: string;
+    session?: string;
+    resumed?: boolean;
 }
 
 interface CoreConfigPayload {
     title: string;
+    avatarVariants?: string;
 }
 
 interface RoomConfigPayload {
@@ -26,6 +29,19 @@ interface TimezonesConfigPayload {
     timezones: string[];
 }
 
+interface ConfigBundleRequestPayload {
+    version: string | null;
+}
+
+interface ConfigBundlePayload {
+    version: string;
+    configs: {[type: string]: unknown};
+}
+
+interface ConfigBundleNotModifiedPayload {
+    version: string;
+}
+
 interface ScheduleConfigPayload {
     title: string;
     start_date: string;
@@ -65,10 +81,6 @@ interface OpenJitsiRoomPayload {
     jwt?: string;
 }
 
-interface UpdateAvatarImagePayload {
-    imageData: string;
-}
-
 interface SetAvatarLocationPayload {
     room: string;
     x: number;
@@ -82,6 +94,38 @@ interface UpdateAvatarLocationPayload {
     y: number;
 }
 
+interface RoomSnapshotPayload {
+    room: string;
+    avatars: UpdateAvatarLocationPayload[];
+    atlas?: AvatarAtlas | null;
+}
+
+interface AvatarAtlas {
+    url: string;
+    frames: {[avatar: string]: [number, number, number, number]};
+}
+
+interface CompiledMapPayload {
+    room: string;
+    width: number;
+    height: number;
+    start: string | null;
+    collision: string;
+    actions: {layer: string; properties: {[x: string]: string | number | boolean}; tiles: string}[];
+    spawns: {[x: string]: [number, number][]};
+}
+
+interface RoomAtlasPayload {
+    room: string;
+    atlas: AvatarAtlas | null;
+}
+
+interface AvatarLocationsPayload {
+    room: string | null;
+    users: UpdateAvatarLocationUserPayload[];
+    locations: [number, number, number][];
+}
+
 interface UpdateAvatarLocationUserPayload {
     id: number;
     avatar: string;
@@ -89,6 +133,11 @@ interface UpdateAvatarLocationUserPayload {
     roles: string[];
 }
 
+interface EnterRoomPayload {
+    room: string;
+    movement?: 'json' | 'binary';
+}
+
 interface LeaveMapPayload {
     room: string;
 }
@@ -12,6 +12,7 @@ const AUTHENTICATED = 4;
 const AUTHENTICATION_FAILED = 5;
 
 const authenticationStatus = writable(NOT_AUTHENTICATED);
+let session = null as string;
 
 messages.subscribe((data) => {
     if (data.type === 'authentication-required') {
@@ -35,6 +36,7 @@ messages.subscribe((data) => {
                     email: auth.email as string,
                     remember: true,
                     token: auth.token as string,
+                    session: session,
                 }
             });
         } else if (sessionLoadValue('authentication', null)) {
@@ -46,6 +48,7 @@ messages.subscribe((data) => {
                     email: auth.email as string,
                     remember: false,
                     token: auth.token as string,
+                    session: session,
                 }
             });
         } else {
@@ -56,10 +59,16 @@ messages.subscribe((data) => {
     } else if (data.type === 'authenticated') {
         authenticationStatus.set(AUTHENTICATED);
         if (data.payload) {
-            if ((data.payload as AuthenticatePayload).remember) {
-                localStoreValue('authentication', data.payload as unknown as NestedStorage);
+            const auth = {
+                email: (data.payload as AuthenticatePayload).email,
+                remember: (data.payload as AuthenticatePayload).remember,
+                token: (data.payload as AuthenticatePayload).token,
+            };
+            session = (data.payload as AuthenticatePayload).session;
+            if (auth.remember) {
+                localStoreValue('authentication', auth as unknown as NestedStorage);
             } else {
-                sessionStoreValue('authentication', data.payload as unknown as NestedStorage);
+                sessionStoreValue('authentication', auth as unknown as NestedStorage);
             }
             if (window.location.search) {
                 window.location.search = '';
@@ -67,6 +76,15 @@ messages.subscribe((data) => {
         }
     } else if (data.type === 'authentication-failed') {
         authenticationStatus.set(AUTHENTICATION_FAILED);
+        session = null;
+    }
+});
+
+window.addEventListener('beforeunload', () => {
+    if (session) {
+        sendMessage({
+            type: 'end-session'
+        });
     }
 });
 
@@ -2,6 +2,7 @@ import { writable, get } from "svelte/store";
 import { navigate } from 'svelte-navigator';
 
 import { messages, sendMessage } from './connection';
+import { localLoadValue, localStoreValue, NestedStorage } from '../storage';
 
 export const coreConfig = writable({'title': 'The Senior Common Room'} as CoreConfigPayload);
 export const rooms = writable([] as RoomConfigPayload[]);
@@ -10,51 +11,70 @@ export const timezones = writable([] as string[]);
 export const schedule = writable([] as ScheduleConfigPayload[]);
 export const links = writable([] as LinkConfigPayload[]);
 
-messages.subscribe((message) => {
-    if (message.type === 'authenticated') {
-        sendMessage({
-            type: 'get-rooms-config'
-        });
-        sendMessage({
-            type: 'get-badges-config'
-        });
-        sendMessage({
-            type: 'get-timezones-config'
-        });
-        sendMessage({
-            type: 'get-schedule-config'
-        });
-        sendMessage({
-            type: 'get-links-config'
-        });
-    } else if (message.type === 'core-config') {
-        coreConfig.set(message.payload as CoreConfigPayload);
-        document.title = (message.payload as CoreConfigPayload).title;
-    } else if (message.type === 'rooms-config') {
+function applyConfig(type: string, payload: unknown) {
+    if (type === 'core-config') {
+        coreConfig.set(payload as CoreConfigPayload);
+        document.title = (payload as CoreConfigPayload).title;
+    } else if (type === 'rooms-config') {
         const pathElements = window.location.pathname.split('/');
         let redirect = true;
         if (pathElements.length > 0) {
             if (pathElements[pathElements.length - 1] === 'profile' || pathElements[pathElements.length - 1] === 'schedule') {
                 redirect = false;
             } else {
-                (message.payload as RoomConfigPayload[]).forEach((room) => {
+                (payload as RoomConfigPayload[]).forEach((room) => {
                     if (room.slug == pathElements[pathElements.length - 1]) {
                         redirect = false;
                     }
                 });
             }
         }
-        rooms.set(message.payload as RoomConfigPayload[]);
-        if (redirect && (message.payload as RoomConfigPayload[]).length > 0) {
-            navigate('/frontend/room/' + (message.payload as RoomConfigPayload[])[0].slug);
+        rooms.set(payload as RoomConfigPayload[]);
+        if (redirect && (payload as RoomConfigPayload[]).length > 0) {
+            navigate('/frontend/room/' + (payload as RoomConfigPayload[])[0].slug);
+        }
+    } else if (type === 'badges-config') {
+        badges.set(payload as BadgeConfigPayload[]);
+    } else if (type === 'timezones-config') {
+        timezones.set((payload as TimezonesConfigPayload).timezones);
+    } else if (type === 'schedule-config') {
+        schedule.set(payload as ScheduleConfigPayload[]);
+    } else if (type === 'links-config') {
+        links.set(payload as LinkConfigPayload[]);
+    }
+}
+
+function applyConfigBundle(bundle: ConfigBundlePayload) {
+    for (const [type, payload] of Object.entries(bundle.configs)) {
+        applyConfig(type, payload);
+    }
+}
+
+messages.subscribe((message) => {
+    if (message.type === 'authenticated') {
+        const cached = localLoadValue('config.bundle', null) as unknown as ConfigBundlePayload | null;
+        sendMessage({
+            type: 'get-config-bundle',
+            payload: {
+                version: cached ? cached.version : null,
+            }
+        });
+        sendMessage({
+            type: 'get-schedule-config'
+        });
+    } else if (message.type === 'config-bundle') {
+        localStoreValue('config.bundle', message.payload as unknown as NestedStorage);
+        applyConfigBundle(message.payload as ConfigBundlePayload);
+    } else if (message.type === 'config-bundle-not-modified') {
+        const cached = localLoadValue('config.bundle', null) as unknown as ConfigBundlePayload | null;
+        if (cached && cached.version === (message.payload as ConfigBundleNotModifiedPayload).version) {
+            applyConfigBundle(cached);
+        } else {
+            sendMessage({
+                type: 'get-config-bundle'
+            });
         }
-    } else if (message.type === 'badges-config') {
-        badges.set(message.payload as BadgeConfigPayload[]);
-    } else if (message.type === 'timezones-config') {
-        timezones.set((message.payload as TimezonesConfigPayload).timezones);
-    } else if (message.type === 'schedule-config') {
-        schedule.set(message.payload as ScheduleConfigPayload[]);
-    } else if (message.type === 'links-config') {
-        links.set(message.payload as LinkConfigPayload[]);
+    } else {
+        applyConfig(message.type, message.payload);
     }
 });
@@ -16,6 +16,28 @@ export const reconnectWait = writable(0);
 let reconnectCount = MAX_RECONNECT_ATTEMPTS + 1;
 let pingTimeout = -1;
 
+const BINARY_AVATAR_LOCATIONS = 1;
+const BINARY_LOCATION_SIZE = 8;
+
+function decodeBinaryMessage(data: ArrayBuffer): ApiMessage {
+    const view = new DataView(data);
+    if (view.getUint8(0) === BINARY_AVATAR_LOCATIONS) {
+        const locations = [] as [number, number, number][];
+        for (let offset = 1; offset + BINARY_LOCATION_SIZE <= view.byteLength; offset = offset + BINARY_LOCATION_SIZE) {
+            locations.push([view.getUint32(offset, true), view.getInt16(offset + 4, true), view.getInt16(offset + 6, true)]);
+        }
+        return {
+            type: 'avatar-locations',
+            payload: {
+                room: null,
+                users: [],
+                locations: locations,
+            }
+        };
+    }
+    return {type: 'unknown-binary-message'};
+}
+
 function reconnectCountdown() {
     reconnectWait.update((value) => { return value - 1});
     if (get(reconnectWait) <= 0 ) {
@@ -37,6 +59,7 @@ export function connect() {
         } else {
             connection = new WebSocket('ws://' + window.location.hostname + ':' + window.location.port + '/api');
         }
+        connection.binaryType = 'arraybuffer';
         connection.addEventListener('open', () => {
             reconnectCount = MAX_RECONNECT_ATTEMPTS + 1;
             connectionStatus.set(CONNECTED);
@@ -57,7 +80,9 @@ export function connect() {
             }
         });
         connection.addEventListener('message', (message) => {
-            if (message.data) {
+            if (message.data instanceof ArrayBuffer) {
+                messages.set(decodeBinaryMessage(message.data));
+            } else if (message.data) {
                 messages.set(JSON.parse(message.data));
             }
         });
@@ -3,7 +3,7 @@ import { authenticate, isAuthenticationRequired, isAuthenticating, isAuthenticat
 import { coreConfig, rooms, badges, schedule, timezones, links } from './config';
 import { action, actionLabel, executeAction } from './action';
 import { overlay } from './overlay';
-import { user, isOnboarded, isOnboarding, onboardingCompleted } from './user';
+import { user, isOnboarded, isOnboarding, onboardingCompleted, uploadAvatarImage, avatarVariant } from './user';
 import { jitsiRoomUsers } from './jitsi';
 import { showSchedule } from './ui';
 
@@ -36,6 +36,8 @@ export {
     isOnboarded,
     isOnboarding,
     onboardingCompleted,
+    uploadAvatarImage,
+    avatarVariant,
 
     executeAction,
     action,
@@ -1,6 +1,8 @@
 import { writable, derived, get } from "svelte/store";
 
 import { messages, sendMessage } from './connection';
+import { coreConfig } from './config';
+import { localLoadValue, sessionLoadValue, NestedStorage } from '../storage';
 
 export const user = writable(null as UserPayload);
 const STARTUP = 0;
@@ -32,6 +34,28 @@ export const isOnboarding = derived(onboardingState, (state) => {
     return state === ONBOARDING;
 });
 
+export function avatarVariant(avatar: string, size: number): string {
+    const prefix = get(coreConfig).avatarVariants || '/api/avatars';
+    return prefix + '/' + avatar.substring(avatar.lastIndexOf('/') + 1) + '-' + size + '.webp';
+}
+
+export async function uploadAvatarImage(imageData: string) {
+    const auth = (localLoadValue('authentication', null) || sessionLoadValue('authentication', null)) as NestedStorage;
+    const image = await (await window.fetch(imageData)).blob();
+    const response = await window.fetch('/api/avatar', {
+        method: 'POST',
+        headers: {
+            'Content-Type': image.type,
+            'X-Email': auth.email as string,
+            'X-Token': auth.token as string,
+        },
+        body: image,
+    });
+    if (!response.ok) {
+        throw new Error('Avatar upload failed');
+    }
+}
+
 export function onboardingCompleted() {
     onboardingState.set(ONBOARDED);
 }
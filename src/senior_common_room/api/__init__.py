@@ -0,0 +1,94 @@
+import logging
+
+from collections import Counter
+from typing import Optional, Union
+
+from .. import metrics
+from ..mqtt import TopicRouter
+
+
+logger = logging.getLogger(__name__)
+
+message_counts = Counter()
+topic_counts = Counter()
+error_counts = Counter()
+
+metrics.register('api', lambda: {
+    'messages': dict(message_counts),
+    'topics': dict(topic_counts),
+    'errors': dict(error_counts)
+})
+
+
+def handles_message(message_type: str, requires: Optional[str] = None):
+    """Register the decorated API method as the handler for WebSocket messages of ``message_type``.
+
+    If ``requires`` is set, the handler is only registered if that key is present in the configuration.
+    """
+    def decorator(func):
+        if not hasattr(func, 'api_dispatch'):
+            func.api_dispatch = []
+        func.api_dispatch.append(('message', message_type, requires, False))
+        return func
+    return decorator
+
+
+def handles_topic(topic_filter: str, requires: Optional[str] = None, with_topic: bool = False):
+    """Register the decorated API method as the handler for MQTT messages matching ``topic_filter``.
+
+    If ``with_topic`` is set, the method is also passed the topic of the message.
+    """
+    def decorator(func):
+        if not hasattr(func, 'api_dispatch'):
+            func.api_dispatch = []
+        func.api_dispatch.append(('topic', topic_filter, requires, with_topic))
+        return func
+    return decorator
+
+
+class DispatchMixin():
+    """Builds the message and topic dispatch tables from the decorated methods of all API mixins."""
+
+    message_handlers = {}
+    topic_handlers = TopicRouter()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.message_handlers = {}
+        cls.topic_handlers = TopicRouter()
+        for name in dir(cls):
+            func = getattr(cls, name, None)
+            for kind, key, requires, with_topic in getattr(func, 'api_dispatch', []):
+                if kind == 'message':
+                    cls.message_handlers[key] = (func, requires)
+                else:
+                    cls.topic_handlers.add(key, (func, requires, key, with_topic))
+
+    async def dispatch_message(self, message: dict):
+        handler = self.message_handlers.get(message.get('type'))
+        if handler and (handler[1] is None or handler[1] in self.config):
+            message_counts[message['type']] += 1
+            await self.dispatch(handler[0], message['type'], message)
+        else:
+            message_counts['unknown'] += 1
+            logger.debug(f'Unhandled message {message.get("type")}')
+
+    async def dispatch_topic(self, topic: str, message: Union[dict, bytes, None]):
+        handlers = self.topic_handlers.match(topic)
+        for func, requires, topic_filter, with_topic in handlers:
+            if requires is None or requires in self.config:
+                topic_counts[topic_filter] += 1
+                await self.dispatch(func, topic_filter, message, topic if with_topic else None)
+        if not handlers:
+            topic_counts['unknown'] += 1
+            logger.debug(f'Unhandled topic {topic}')
+
+    async def dispatch(self, func, key: str, message: Union[dict, bytes, None], topic: Optional[str] = None):
+        try:
+            if topic is None:
+                await func(self, message)
+            else:
+                await func(self, message, topic)
+        except Exception as e:
+            error_counts[key] += 1
+            logger.error(f'Error handling {key}: {e}')
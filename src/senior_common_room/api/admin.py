@@ -1,29 +1,37 @@
-import asyncio
-import json
 import logging
 
+from .. import codec, metrics
+from . import handles_message, handles_topic
+
 
 logger = logging.getLogger(__name__)
 
 
 class AdminMixin():
 
-    admin_messages_mqtt_task = None
-
-    async def setup_admin_messages_task(self):
-        self.admin_messages_mqtt_task = asyncio.create_task(self.on_mqtt_messages(f'messages/admin'))
+    async def subscribe_admin_messages(self):
+        await self.mqtt_subscribe('messages/admin', raw=True)
 
-    async def send_ui_reload(self):
+    @handles_message('admin-ui-reload')
+    async def send_ui_reload(self, message=None):
         if 'admin' in self.user.roles:
-            await self.mqtt.publish(f'messages/admin', payload=json.dumps({
+            await self.mqtt.publish(f'messages/admin', payload=codec.dumps({
                                         'action': 'ui-reload'
                                     }))
 
-    async def receive_ui_reload(self):
+    @handles_message('get-server-metrics')
+    async def get_server_metrics(self, message=None):
+        if self.user and 'admin' in self.user.roles:
+            await self.send_message({
+                'type': 'server-metrics',
+                'payload': {
+                    'node': self.mqtt.node_id,
+                    'metrics': metrics.snapshot()
+                }
+            })
+
+    @handles_topic('messages/admin')
+    async def receive_ui_reload(self, message=None):
         await self.send_message({
             'type': 'ui-reload'
         })
-
-    def teardown_admin_task(self):
-        if self.admin_messages_mqtt_task:
-            self.admin_messages_mqtt_task.cancel()
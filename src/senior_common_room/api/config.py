@@ -1,84 +1,113 @@
 import logging
 
-from pytz import timezone, common_timezones
+from datetime import datetime
+from hashlib import sha256
+from pytz import common_timezones, utc
+
+from .. import codec
+from . import handles_message
 
 
 logger = logging.getLogger(__name__)
 
 
-class ConfigMixin():
+def parse_timestamp(value: str) -> datetime:
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        timestamp = utc.localize(timestamp)
+    return timestamp
 
-    async def get_core_config(self):
-        await self.send_message({
-            'type': 'core-config',
-            'payload': self.config['core']
-        })
 
-    async def get_rooms_config(self):
-        await self.send_message({
-            'type': 'rooms-config',
-            'payload': self.config['rooms']
-        })
+class ConfigFrames():
+    """The static configuration payloads, each serialised once at startup.
 
-    async def get_badges_config(self):
-        if 'badges' in self.config:
-            await self.send_message({
-                'type': 'badges-config',
-                'payload': self.config['badges']
-            })
-        else:
-            await self.send_message({
-                'type': 'badges-config',
-                'payload': []
-            })
-
-    async def get_links_config(self):
-        if 'links' in self.config:
-            await self.send_message({
-                'type': 'links-config',
-                'payload': self.config['links']
-            })
-        else:
-            await self.send_message({
-                'type': 'links-config',
-                'payload': []
-            })
-
-    async def get_schedule_config(self):
-        tz = timezone('UTC')
-        try:
-            tz = timezone(self.user.timezone)
-        except:
-            pass
-        def localise_schedule_entry(entry):
-            start = entry['start'].astimezone(tz)
-            end = entry['end'].astimezone(tz)
-            return {
-                'title': entry['title'],
-                'start_date': start.strftime('%d %B %Y'),
-                'start_time': start.strftime('%H:%M %Z'),
-                'end_date': end.strftime('%d %B %Y'),
-                'end_time': end.strftime('%H:%M %Z'),
-                'day_diff': (end - start).days + 1 if start.year != end.year or start.month != end.month or start.day != end.day else 0,
-                'room': entry['room'],
-                'description': entry['description']
+    The ``version`` is a hash over all payloads. Clients that present the current version when requesting the
+    config bundle only receive a short not-modified frame.
+    """
+
+    def __init__(self, config: dict):
+        self.payloads = {
+            'core-config': dict(config['core'], avatarVariants=config['server']['prefixes']['variants']),
+            'rooms-config': [dict([(key, value) for key, value in room.items() if key != 'mapFile'])
+                             for room in config['rooms']],
+            'badges-config': config['badges'] if 'badges' in config else [],
+            'links-config': config['links'] if 'links' in config else [],
+            'timezones-config': {
+                'timezones': list(common_timezones)
+            },
+        }
+        self.frames = dict([(key, codec.dumps({'type': key, 'payload': payload}))
+                            for key, payload in self.payloads.items()])
+        self.version = sha256(codec.canonical(self.payloads)).hexdigest()[:16]
+        self.bundle_frame = codec.dumps({
+            'type': 'config-bundle',
+            'payload': {
+                'version': self.version,
+                'configs': self.payloads
+            }
+        })
+        self.not_modified_frame = codec.dumps({
+            'type': 'config-bundle-not-modified',
+            'payload': {
+                'version': self.version
             }
+        })
+
+
+class ConfigMixin():
 
-        if 'schedule' in self.config:
-            await self.send_message({
-                'type': 'schedule-config',
-                'payload': [localise_schedule_entry(entry) for entry in self.config['schedule']]
-            })
+    @handles_message('get-config-bundle')
+    async def get_config_bundle(self, message=None):
+        if message and 'payload' in message and message['payload'].get('version') == self.config_frames.version:
+            await self.send_frame(self.config_frames.not_modified_frame)
         else:
-            await self.send_message({
-                'type': 'schedule-config',
-                'payload': []
-            })
+            await self.send_frame(self.config_frames.bundle_frame)
+
+    @handles_message('get-core-config')
+    async def get_core_config(self, message=None):
+        await self.send_frame(self.config_frames.frames['core-config'])
+
+    @handles_message('get-rooms-config')
+    async def get_rooms_config(self, message=None):
+        await self.send_frame(self.config_frames.frames['rooms-config'])
 
-    async def get_timezones_config(self):
+    @handles_message('get-badges-config')
+    async def get_badges_config(self, message=None):
+        await self.send_frame(self.config_frames.frames['badges-config'])
+
+    @handles_message('get-links-config')
+    async def get_links_config(self, message=None):
+        await self.send_frame(self.config_frames.frames['links-config'])
+
+    @handles_message('get-schedule-config')
+    async def get_schedule_config(self, message=None):
+        await self.send_frame(self.schedule.frame(self.user_timezone()))
+
+    @handles_message('get-schedule-entries')
+    async def get_schedule_entries(self, message):
+        tz_name = self.user_timezone()
+        query = message['payload']['query']
+        if query == 'now':
+            entries = self.schedule.now(tz_name)
+        elif query == 'next':
+            entries = self.schedule.next(tz_name, count=min(int(message['payload'].get('count', 1)), 100))
+        elif query == 'range':
+            entries = self.schedule.range(tz_name,
+                                          parse_timestamp(message['payload']['start']),
+                                          parse_timestamp(message['payload']['end']))
+        else:
+            return
         await self.send_message({
-            'type': 'timezones-config',
+            'type': 'schedule-entries',
             'payload': {
-                'timezones': common_timezones
+                'query': query,
+                'entries': entries
             }
         })
+
+    def user_timezone(self) -> str:
+        return self.schedule.timezone_name(self.user.timezone if self.user else None)
+
+    @handles_message('get-timezones-config')
+    async def get_timezones_config(self, message=None):
+        await self.send_frame(self.config_frames.frames['timezones-config'])
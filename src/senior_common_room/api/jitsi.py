@@ -1,8 +1,13 @@
-import asyncio
-import json
 import jwt
 import logging
 
+from time import monotonic
+from tornado.ioloop import IOLoop
+
+from .. import codec
+from ..outbound import COALESCE
+from . import handles_message, handles_topic
+
 
 logger = logging.getLogger(__name__)
 
@@ -10,17 +15,41 @@ logger = logging.getLogger(__name__)
 class JitsiMixin():
 
     jitsi_room_name = None
-    jitsi_room_mqtt_task = None
+    jitsi_room = None
+    jitsi_lease_refreshed = 0
 
+    @handles_message('enter-jitsi-room', requires='jitsi')
     async def request_jitsi_room(self, message):
         self.jitsi_room_name = message['payload']['name']
+        self.jitsi_lease_refreshed = monotonic()
         await self.mqtt.publish(f'jitsi-rooms/{self.jitsi_room_name}/enter',
-                                payload=json.dumps({
+                                payload=codec.dumps({
                                     'user': self.user.id,
+                                    'node': self.mqtt.node_id,
                                     'subject': message['payload']['subject']
-                                }).encode())
+                                }))
+
+    async def jitsi_announce(self):
+        """Move the membership of the current jitsi room to the current node id of the MQTT client."""
+        if self.jitsi_room_name and self.jitsi_room:
+            await self.mqtt.publish(f'jitsi-rooms/{self.jitsi_room_name}/enter',
+                                    payload=codec.dumps({
+                                        'user': self.user.id,
+                                        'node': self.mqtt.node_id,
+                                        'subject': self.jitsi_room['subject'],
+                                        'rejoin': True
+                                    }))
 
+    def refresh_jitsi_lease(self):
+        """Renew the lease on the current jitsi room membership, at most three times per lease period."""
+        if self.jitsi_room_name and monotonic() - self.jitsi_lease_refreshed > self.config['jitsi']['lease'] / 3:
+            self.jitsi_lease_refreshed = monotonic()
+            IOLoop.current().add_callback(self.send_mqtt_message, f'jitsi-rooms/{self.jitsi_room_name}/heartbeat',
+                                          {'user': self.user.id, 'node': self.mqtt.node_id})
+
+    @handles_topic('user/+/enter-jitsi-room', requires='jitsi')
     async def enter_jitsi_room(self, message):
+        message = dict(message)
         self.jitsi_room_name = message['room_name']
         if 'jwt' in self.config['jitsi']:
             encoded_jwt = jwt.encode({
@@ -30,46 +59,45 @@ class JitsiMixin():
                 'aud': self.config['jitsi']['jwt']['client_id']
             }, self.config['jitsi']['jwt']['secret'], algorithm='HS256')
             message['jwt'] = encoded_jwt
+        self.jitsi_room = message
         await self.send_message({
             'type': 'open-jitsi-room',
             'payload': message
         })
-        self.jitsi_room_mqtt_task = asyncio.create_task(self.on_mqtt_messages(f'jitsi-rooms/{self.jitsi_room_name}/user-list'))
+        await self.mqtt_subscribe(f'jitsi-rooms/{self.jitsi_room_name}/user-list', raw=True)
+        self.jitsi_lease_refreshed = 0
+        self.refresh_jitsi_lease()
         logger.debug(f'Entered Jitsi Room {self.jitsi_room_name}')
 
-    async def leave_jitsi_room(self):
+    @handles_message('leave-jitsi-room', requires='jitsi')
+    @handles_topic('user/+/leave_jitsi_room')
+    async def leave_jitsi_room(self, message=None):
         if self.jitsi_room_name:
             logger.debug(f'Leaving Jitsi Room {self.jitsi_room_name}')
             await self.mqtt.publish(f'jitsi-rooms/{self.jitsi_room_name}/leave',
-                                    payload=json.dumps({
+                                    payload=codec.dumps({
                                         'user': self.user.id,
-                                    }).encode())
+                                    }))
+            await self.mqtt_unsubscribe(f'jitsi-rooms/{self.jitsi_room_name}/user-list')
             self.jitsi_room_name = None
-            if self.jitsi_room_mqtt_task:
-                self.jitsi_room_mqtt_task.cancel()
-            self.jitsi_room_mqtt_task = None
+            self.jitsi_room = None
             await self.send_message({
                 'type': 'left-jitsi-room'
             })
 
-    async def request_jitsi_room_users(self):
+    @handles_message('get-jitsi-room-users', requires='jitsi')
+    async def request_jitsi_room_users(self, message=None):
         if self.jitsi_room_name:
             await self.send_mqtt_message(f'jitsi-rooms/{self.jitsi_room_name}/request-user-list')
 
-    async def jitsi_room_user_list(self, message):
-        if self.jitsi_room_name:
-            await self.send_message({
-                'type': 'jitsi-room-users',
-                'payload': {
-                    'users': message['users']
-                }
-            })
+    @handles_topic('jitsi-rooms/+/user-list', with_topic=True)
+    async def jitsi_room_user_list(self, message: bytes, topic: str):
+        if self.jitsi_room_name and topic.split('/')[1] == self.jitsi_room_name:
+            await self.send_frame(codec.frame('jitsi-room-users', message), kind=COALESCE, key='jitsi-room-users')
 
     async def jitsi_shutdown(self):
         if self.jitsi_room_name:
             await self.mqtt.publish(f'jitsi-rooms/{self.jitsi_room_name}/leave',
-                                    payload=json.dumps({
+                                    payload=codec.dumps({
                                         'user': self.user.id,
-                                    }).encode())
-        if self.jitsi_room_mqtt_task:
-            self.jitsi_room_mqtt_task.cancel()
+                                    }))
@@ -1,8 +1,9 @@
-import asyncio
 import bleach
-import json
 import logging
 
+from .. import codec
+from . import handles_message, handles_topic
+
 
 logger = logging.getLogger(__name__)
 
@@ -19,29 +20,25 @@ def safe_text(text: str) -> str:
 
 class MessagesMixin():
 
-    broadcast_messages_mqtt_task = None
-
-    async def setup_messages_task(self):
-        self.broadcast_messages_mqtt_task = asyncio.create_task(self.on_mqtt_messages(f'messages/broadcast'))
+    async def subscribe_messages(self):
+        await self.mqtt_subscribe('messages/broadcast', raw=True)
 
+    @handles_message('broadcast-message')
     async def send_broadcast_message(self, message):
         if 'admin' in self.user.roles:
             await self.mqtt.publish(f'messages/broadcast',
-                                    payload=json.dumps({
+                                    payload=codec.dumps({
                                         'message': safe_text(message['payload']['message'])
                                     }))
 
-    async def receive_broadcast_message(self, message):
-        await self.send_message({
-            'type': 'broadcast-message',
-            'payload': {
-                'message': message['message'],
-            }
-        })
+    @handles_topic('messages/broadcast')
+    async def receive_broadcast_message(self, message: bytes):
+        await self.send_frame(codec.frame('broadcast-message', message), replay=True)
 
+    @handles_message('user-message')
     async def send_user_message(self, message):
         await self.mqtt.publish(f'user/{message["payload"]["user"]["id"]}/message',
-                                payload=json.dumps({
+                                payload=codec.dumps({
                                     'user': {
                                         'id': self.user.id,
                                         'name': self.user.name,
@@ -50,6 +47,7 @@ class MessagesMixin():
                                     'message': safe_text(message['payload']['message'])
                                 }))
 
+    @handles_topic('user/+/message')
     async def receive_user_message(self, message):
         if not self.user.blocked_users or message['user']['id'] not in self.user.blocked_users:
             await self.send_message({
@@ -58,11 +56,12 @@ class MessagesMixin():
                     'user': message['user'],
                     'message': message['message']
                 }
-            })
+            }, replay=True)
 
+    @handles_message('request-video-chat-message')
     async def send_request_video_chat_message(self, message):
         await self.mqtt.publish(f'user/{message["payload"]["user"]["id"]}/request-video-chat',
-                                payload=json.dumps({
+                                payload=codec.dumps({
                                     'user': {
                                         'id': self.user.id,
                                         'name': self.user.name,
@@ -70,9 +69,10 @@ class MessagesMixin():
                                     }
                                 }))
 
+    @handles_message('request-join-video-chat-message')
     async def send_request_join_video_chat_message(self, message):
         await self.mqtt.publish(f'user/{message["payload"]["user"]["id"]}/request-video-chat',
-                                payload=json.dumps({
+                                payload=codec.dumps({
                                     'user': {
                                         'id': self.user.id,
                                         'name': self.user.name,
@@ -81,6 +81,7 @@ class MessagesMixin():
                                     'room': message['payload']['room']
                                 }))
 
+    @handles_topic('user/+/request-video-chat')
     async def receive_request_video_chat_message(self, message):
         if not self.user.blocked_users or message['user']['id'] not in self.user.blocked_users:
             if 'room' in message:
@@ -90,25 +91,22 @@ class MessagesMixin():
                         'user': message['user'],
                         'room': message['room']
                     }
-                })
+                }, replay=True)
             else:
                 await self.send_message({
                     'type': 'request-video-chat',
                     'payload': {
                         'user': message['user']
                     }
-                })
+                }, replay=True)
 
+    @handles_message('accept-video-chat-message')
     async def send_accept_video_chat_message(self, message):
         if self.jitsi_room_name:
             await self.send_mqtt_message(f'jitsi-rooms/{self.jitsi_room_name}/enter',
                                          {'user': message['payload']['user']['id']})
         else:
             await self.mqtt.publish(f'jitsi-rooms/_private/enter',
-                                    payload=json.dumps({
+                                    payload=codec.dumps({
                                         'users': [self.user.id, message['payload']['user']['id']]
                                     }))
-
-    def teardown_messages_task(self):
-        if self.broadcast_messages_mqtt_task:
-            self.broadcast_messages_mqtt_task.cancel()
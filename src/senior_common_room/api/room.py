@@ -1,7 +1,10 @@
-import asyncio
-import json
 import logging
 
+from .. import codec
+from ..movement import valid_location
+from ..outbound import COALESCE, MOVEMENT
+from . import handles_message, handles_topic
+
 
 logger = logging.getLogger(__name__)
 
@@ -9,37 +12,80 @@ logger = logging.getLogger(__name__)
 class RoomMixin():
 
     room_name = None
+    room_movement_protocol = 'json'
 
+    @handles_message('enter-room')
     async def enter_room(self, message):
-        self.room_name = message['payload']['room']
-        self.room_mqtt_task = asyncio.create_task(self.on_mqtt_messages(f'room/{self.room_name}/+'))
+        if message['payload'].get('movement') in ['json', 'binary']:
+            self.room_movement_protocol = message['payload']['movement']
+        if self.room_name != message['payload']['room']:
+            if self.room_name:
+                await self.leave_room(None)
+            self.room_name = message['payload']['room']
+            await self.movement.join(self.room_name, self)
+            await self.mqtt_subscribe(f'room/{self.room_name}/atlas', raw=True)
+            await self.room_announce_avatar()
+        await self.mqtt.publish(f'room/{self.room_name}/request-snapshot',
+                                payload=codec.dumps({
+                                    'user': self.user.id
+                                }))
 
+    async def room_announce_avatar(self):
+        if self.room_name:
+            await self.mqtt.publish(f'room/{self.room_name}/enter',
+                                    payload=codec.dumps({
+                                        'user': {
+                                            'id': self.user.id,
+                                            'avatar': f'{self.config["server"]["prefixes"]["avatars"]}/{self.user.avatar}',
+                                            'name': self.user.name,
+                                            'roles': self.user.roles,
+                                        },
+                                        'node': self.mqtt.node_id
+                                    }))
+
+    @handles_message('set-avatar-location')
     async def room_set_avatar_location(self, message):
-        await self.mqtt.publish(f'room/{self.room_name}/set-avatar-location',
-                                payload=json.dumps({
-                                    'user': {
-                                        'id': self.user.id,
-                                        'avatar': f'{self.config["server"]["prefixes"]["avatars"]}/{self.user.avatar}',
-                                        'name': self.user.name,
-                                        'roles': self.user.roles,
-                                    },
-                                    'room': message['payload']['room'],
-                                    'x': message['payload']['x'],
-                                    'y': message['payload']['y']
-                                }))
+        if message['payload']['room'] == self.room_name:
+            if not valid_location(message['payload'].get('x'), message['payload'].get('y')) or \
+                    not self.maps.allows(self.room_name, message['payload']['x'], message['payload']['y']):
+                logger.debug(f'Rejected avatar location {message["payload"]["x"]},{message["payload"]["y"]} '
+                             f'in {self.room_name}')
+                return
+            await self.mqtt.publish(f'room/{self.room_name}/set-avatar-location',
+                                    payload=codec.dumps([self.user.id,
+                                                         message['payload']['x'],
+                                                         message['payload']['y']]))
 
-    async def room_update_avatar_location(self, message):
-        if message['user']['id'] != self.user.id and message['room'] == self.room_name:
+    @handles_topic('user/+/room-snapshot')
+    async def room_snapshot(self, message):
+        if message['room'] == self.room_name:
+            self.movement.seed(self.room_name, message['avatars'])
             await self.send_message({
-                'type': 'update-avatar-location',
+                'type': 'room-snapshot',
                 'payload': {
-                    'user': message['user'],
                     'room': message['room'],
-                    'x': message['x'],
-                    'y': message['y']
+                    'avatars': message['avatars'],
+                    'atlas': message.get('atlas')
                 }
             })
 
+    @handles_topic('room/+/atlas', with_topic=True)
+    async def room_atlas(self, message: bytes, topic: str):
+        if self.room_name and topic.split('/')[1] == self.room_name:
+            await self.send_frame(codec.frame('room-atlas', message), kind=COALESCE, key='room-atlas')
+
+    async def room_update_avatar_locations(self, batch):
+        if batch.room_name == self.room_name and batch.user_ids != {self.user.id}:
+            if self.room_movement_protocol == 'binary':
+                if batch.users:
+                    await self.send_frame(batch.users_frame)
+                if batch.locations:
+                    await self.send_frame(batch.binary_frame, binary=True, kind=MOVEMENT, key=batch)
+            elif batch.users:
+                await self.send_frame(batch.json_frame)
+            else:
+                await self.send_frame(batch.json_frame, kind=MOVEMENT, key=batch)
+
     async def room_remove_avatar(self, message):
         if message['user'] != self.user.id and message['room'] == self.room_name:
             await self.send_message({
@@ -49,17 +95,17 @@ class RoomMixin():
                 }
             })
 
+    @handles_message('leave-room')
     async def leave_room(self, message):
-        await self.mqtt.publish(f'room/{self.room_name}/leave',
-                                payload=json.dumps({
-                                    'user': self.user.id,
-                                    'room': self.room_name,
-                                }))
-        await self.mqtt.unsubscribe(f'room/{self.room_name}/+')
-        if self.room_mqtt_task:
-            self.room_mqtt_task.cancel()
-            self.room_mqtt_task = None
-        self.room_name = None
+        if self.room_name:
+            await self.movement.leave(self.room_name, self)
+            await self.mqtt_unsubscribe(f'room/{self.room_name}/atlas')
+            await self.mqtt.publish(f'room/{self.room_name}/leave',
+                                    payload=codec.dumps({
+                                        'user': self.user.id,
+                                        'room': self.room_name,
+                                    }))
+            self.room_name = None
 
     async def teardown_room(self):
         if self.room_name:
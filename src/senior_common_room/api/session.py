@@ -0,0 +1,69 @@
+import logging
+
+from . import handles_message
+
+
+logger = logging.getLogger(__name__)
+
+
+class SessionMixin():
+
+    session_id = None
+    parked = False
+    missed_frames = ()
+
+    def session_state(self) -> dict:
+        return {
+            'user': self.user.id,
+            'node': self.mqtt.node_id,
+            'room_name': self.room_name,
+            'room_movement_protocol': self.room_movement_protocol,
+            'jitsi_room_name': self.jitsi_room_name,
+            'jitsi_room': self.jitsi_room,
+            'replay': [frame.decode() if isinstance(frame, bytes) else frame for frame in self.replay],
+        }
+
+    async def resume_session(self, state: dict):
+        """Take over the room and Jitsi room memberships and the buffered messages of a previous connection."""
+        logger.debug(f'Resuming session {self.session_id}')
+        self.room_movement_protocol = state['room_movement_protocol']
+        if state['room_name']:
+            self.room_name = state['room_name']
+            await self.movement.join(self.room_name, self)
+            await self.mqtt_subscribe(f'room/{self.room_name}/atlas', raw=True)
+            if state['node'] != self.mqtt.node_id:
+                await self.room_announce_avatar()
+        if state['jitsi_room_name']:
+            self.jitsi_room_name = state['jitsi_room_name']
+            self.jitsi_room = state['jitsi_room']
+            await self.send_message({
+                'type': 'open-jitsi-room',
+                'payload': self.jitsi_room
+            })
+            await self.mqtt_subscribe(f'jitsi-rooms/{self.jitsi_room_name}/user-list', raw=True)
+            self.jitsi_lease_refreshed = 0
+            self.refresh_jitsi_lease()
+        self.missed_frames = state['replay']
+
+    async def detach_session(self):
+        """Hand this handler's session over to another connection, without leaving any rooms."""
+        self.session_id = None
+        self.mqtt.remove_on_reconnect(self.on_mqtt_reconnect)
+        if self.room_name:
+            await self.movement.leave(self.room_name, self)
+            self.room_name = None
+        self.jitsi_room_name = None
+        await self.mqtt_unsubscribe_all()
+        if not self.parked:
+            self.close()
+
+    @handles_message('get-missed-messages')
+    async def get_missed_messages(self, message):
+        frames = self.missed_frames
+        self.missed_frames = ()
+        for frame in frames:
+            await self.send_frame(frame.encode())
+
+    @handles_message('end-session')
+    async def end_session(self, message):
+        self.sessions.discard(self)
@@ -1,58 +1,93 @@
-import asyncio
 import logging
-import smtplib
-import os
 
-from base64 import b64decode
 from email.message import EmailMessage
 from email.utils import formatdate
-from io import BytesIO
-from PIL import Image, ImageDraw, ImageOps
 from secrets import token_hex
-from sqlalchemy import and_
+from sqlalchemy import and_, func
 from sqlalchemy.future import select
+from tornado.ioloop import IOLoop
+from typing import Optional
 from urllib.parse import quote_plus
 
+from . import handles_message, handles_topic
 from ..models import User
 
 
 logger = logging.getLogger(__name__)
 
 
+async def find_active_user(sessionmaker, user_cache, email: str, token: str) -> Optional[User]:
+    """Find the active user with the e-mail address and login token, using the cache where possible."""
+    email = email.lower()
+    user = user_cache.get(email, token)
+    if user is None:
+        async with sessionmaker() as session:
+            query = select(User).filter(and_(func.lower(User.email) == email,
+                                             User.token == token,
+                                             User.status == 'active'))
+            result = await session.execute(query)
+            user = result.scalars().first()
+        if user:
+            user_cache.put(email, token, user)
+    return user
+
+
+async def store_avatar(sessionmaker, avatars, user: User, large: bytes, small: bytes):
+    """Store the avatar images and assign them to the user. The previous avatar is deleted if no other user
+    has it."""
+    previous = user.avatar
+    async with sessionmaker() as session:
+        session.add(user)
+        user.avatar = await avatars.write(large, small)
+        await session.commit()
+        if previous and previous != user.avatar:
+            result = await session.execute(select(func.count(User.id)).filter(User.avatar == previous))
+            if result.scalar() == 0:
+                await IOLoop.current().run_in_executor(None, avatars.remove, previous)
+
+
 class UserMixin():
 
+    @handles_message('authenticate')
     async def authenticate(self, message):
         if 'payload' in message and 'email' in message['payload'] and 'remember' in message['payload']:
             if 'token' in message['payload']:
-                async with self.sessionmaker() as session:
-                    logger.debug(f'Logging in user {message["payload"]["email"].lower()}')
-                    query = select(User).filter(and_(User.email == message['payload']['email'].lower(),
-                                                     User.token == message['payload']['token'],
-                                                     User.status == 'active'))
-                    result = await session.execute(query)
-                    user = result.scalars().first()
-                    if user:
-                        self.user = user
-                        await self.send_message({
-                            'type': 'authenticated',
-                            'payload': {
-                                'email': message['payload']['email'].lower(),
-                                'remember': message['payload']['remember'],
-                                'token': message['payload']['token'],
-                            }
-                        })
-                        self.user_mqtt_task = asyncio.create_task(self.on_mqtt_messages(f'user/{self.user.id}/+'))
-                        return
+                logger.debug(f'Logging in user {message["payload"]["email"].lower()}')
+                user = await find_active_user(self.sessionmaker, self.user_cache, message['payload']['email'],
+                                              message['payload']['token'])
+                if user:
+                    self.user = user
+                    await self.mqtt_subscribe(f'user/{self.user.id}/+')
+                    self.sessions.discard(self)
+                    previous, state = await self.sessions.claim(message['payload'].get('session'), self.user.id)
+                    self.session_id = message['payload']['session'] if state else token_hex(16)
+                    await self.send_message({
+                        'type': 'authenticated',
+                        'payload': {
+                            'email': message['payload']['email'].lower(),
+                            'remember': message['payload']['remember'],
+                            'token': message['payload']['token'],
+                            'session': self.session_id,
+                            'resumed': state is not None,
+                        }
+                    })
+                    if state:
+                        await self.resume_session(state)
+                    if previous:
+                        await previous.detach_session()
+                    self.sessions.register(self)
+                    return
             else:
                 async with self.sessionmaker() as session:
                     logger.debug(f'Finding user {message["payload"]["email"].lower()}')
-                    query = select(User).filter(User.email == message['payload']['email'].lower())
+                    query = select(User).filter(func.lower(User.email) == message['payload']['email'].lower())
                     result = await session.execute(query)
                     user = result.scalars().first()
                     if user:
                         logger.debug(f'Generating and e-mailing login token')
                         user.token = token_hex(64)
                         await session.commit()
+                        await self.send_mqtt_message(f'user/{user.id}/updated')
 
                         email = EmailMessage()
                         email.set_content(f'''Hello {user.name},
@@ -67,19 +102,18 @@ This e-mail is automatically generated. Please do not reply to it.
                         email['From'] = self.config['email']['from']
                         email['To'] = user.email
                         email['Date'] = formatdate()
-                        smtp = smtplib.SMTP(self.config['email']['server'])
-                        if self.config['email']['secure']:
-                            smtp.starttls()
-                        if self.config['email']['authentication']:
-                            smtp.login(self.config['email']['authentication']['username'],
-                                       self.config['email']['authentication']['password'])
-                        smtp.send_message(email)
-                        smtp.quit()
-
-                        logger.debug(f'/frontend/?email={message["payload"]["email"]}&token={user.token}')
-                        await self.send_message({
-                            'type': 'authentication-token-sent'
-                        })
+                        if self.mail.send(email):
+                            logger.debug(f'/frontend/?email={message["payload"]["email"]}&token={user.token}')
+                            await self.send_message({
+                                'type': 'authentication-token-sent'
+                            })
+                        else:
+                            await self.send_message({
+                                'type': 'authentication-failed',
+                                'payload': {
+                                    'email': 'Too many login requests, please try again in a moment',
+                                }
+                            })
                         return
         await self.send_message({
             'type': 'authentication-failed',
@@ -88,12 +122,17 @@ This e-mail is automatically generated. Please do not reply to it.
             }
         })
 
+    @handles_topic('user/+/reconnect')
+    async def reconnect(self, message):
+        if self.parked:
+            self.sessions.expire(self.session_id)
+        else:
+            self.sessions.discard(self)
+            self.close()
+
+    @handles_message('get-user')
     async def get_user(self, message):
-        if self.user is None or self.user.avatar is None \
-                or not os.path.exists(os.path.join(self.config['storage']['avatars'],
-                                                   f'{self.user.avatar}-large.png')) \
-                or not os.path.exists(os.path.join(self.config['storage']['avatars'],
-                                                   f'{self.user.avatar}-small.png')):
+        if self.user is None or not self.avatars.exists(self.user.avatar):
             await self.send_message({
                 'type': 'onboarding-required'
             })
@@ -111,6 +150,7 @@ This e-mail is automatically generated. Please do not reply to it.
                 }
             })
 
+    @handles_message('update-user-profile')
     async def update_user_profile(self, message):
         async with self.sessionmaker() as session:
             session.add(self.user)
@@ -128,63 +168,22 @@ This e-mail is automatically generated. Please do not reply to it.
                                   if role != 'admin'])
                 self.user.roles = new_roles
             await session.commit()
+        await self.send_mqtt_message(f'user/{self.user.id}/updated')
         await self.get_user(None)
+        await self.room_announce_avatar()
         if 'timezone' in message['payload']:
             await self.get_schedule_config()
 
-    async def update_avatar_image(self, message):
-        logger.debug('Updating the avatar image')
-        if message['payload']['imageData'].startswith('data:'):
-            message = message['payload']['imageData'][5:]
-            filetype, b64data = message.split(';')
-            if filetype in ['image/png', 'image/jpeg']:
-                if b64data.startswith('base64,'):
-                    b64data = b64data[7:]
-                if os.path.exists(os.path.join(self.config['storage']['avatars'], f'{self.user.avatar}-large.png')):
-                    os.unlink(os.path.join(self.config['storage']['avatars'], f'{self.user.avatar}-large.png'))
-                if os.path.exists(os.path.join(self.config['storage']['avatars'], f'{self.user.avatar}-small.png')):
-                    os.unlink(os.path.join(self.config['storage']['avatars'], f'{self.user.avatar}-small.png'))
-                buffer = BytesIO(b64decode(b64data))
-                if filetype == 'image/png':
-                    format = 'PNG'
-                elif filetype == 'image/jpeg':
-                    format = 'JPEG'
-                img = Image.open(buffer, formats=[format])
-                if img.size[0] != img.size[1]:
-                    if img.size[0] < img.size[1]:
-                        img = ImageOps.fit(img, (img.size[0], img.size[0]), centering=(0.5, 0.5))
-                    else:
-                        img = ImageOps.fit(img, (img.size[1], img.size[1]), centering=(0.5, 0.5))
-                mask = Image.new('L', img.size, 0)
-                draw = ImageDraw.Draw(mask)
-                draw.ellipse((0, 0) + img.size, fill=255)
-                img.putalpha(mask)
-                updated = False
-                suffix = ''
-                while not updated:
-                    try:
-                        async with self.sessionmaker() as session:
-                            session.add(self.user)
-                            self.user.avatar = token_hex(16)
-                            await session.commit()
-                            updated = True
-                    except Exception as e:
-                        pass
-                os.makedirs(self.config['storage']['avatars'], exist_ok=True)
-                with open(os.path.join(self.config['storage']['avatars'], f'{self.user.avatar}-large.png'), 'wb') as out_f:
-                    img.save(out_f, format='PNG')
-                with open(os.path.join(self.config['storage']['avatars'], f'{self.user.avatar}-small.png'), 'wb') as out_f:
-                    img.thumbnail((48, 48))
-                    img.save(out_f, format='PNG')
-                await self.send_message({
-                    'type': 'avatar-image-updated'
-                })
-                logger.debug('Avatar image updated')
-                return
+    @handles_topic('user/+/avatar-updated')
+    async def avatar_updated(self, message):
+        self.user.avatar = message['avatar']
         await self.send_message({
-            'type': 'avatar-image-update-failed'
+            'type': 'avatar-image-updated'
         })
+        await self.room_announce_avatar()
+        logger.debug('Avatar image updated')
 
+    @handles_message('block-user')
     async def block_user(self, message):
         async with self.sessionmaker() as session:
             session.add(self.user)
@@ -193,12 +192,15 @@ This e-mail is automatically generated. Please do not reply to it.
             elif message['payload']['user']['id'] not in self.user.blocked_users:
                 self.user.blocked_users.append(message['payload']['user']['id'])
             await session.commit()
+        await self.send_mqtt_message(f'user/{self.user.id}/updated')
         await self.get_user(None)
 
+    @handles_message('unblock-user')
     async def unblock_user(self, message):
         async with self.sessionmaker() as session:
             session.add(self.user)
             if self.user.blocked_users and message['payload']['user']['id'] in self.user.blocked_users:
                 self.user.blocked_users.remove(message['payload']['user']['id'])
             await session.commit()
+        await self.send_mqtt_message(f'user/{self.user.id}/updated')
         await self.get_user(None)
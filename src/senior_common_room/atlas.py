@@ -0,0 +1,90 @@
+import logging
+import os
+
+from hashlib import sha256
+from heapq import heappop, heappush
+from io import BytesIO
+from PIL import Image
+from typing import Optional
+
+from .avatars import AvatarStore, write_file
+
+
+logger = logging.getLogger(__name__)
+
+
+class RoomAtlas():
+    """A sprite atlas of the small avatar images of the users in one room, packed into a grid of square cells.
+
+    :meth:`update` only draws the avatars that are new since the last update and frees the cells of those that have
+    gone, which are then re-used, so the atlas is built incrementally as users enter and leave. Atlas images are
+    named by their content hash, written to ``directory`` and served below the URL ``prefix``.
+    """
+
+    CELL = 48
+
+    def __init__(self, avatars: AvatarStore, directory: str, prefix: str, columns: int = 16):
+        self.avatars = avatars
+        self.directory = directory
+        self.prefix = prefix.rstrip('/')
+        self.columns = columns
+        self.image = Image.new('RGBA', (columns * self.CELL, self.CELL), (0, 0, 0, 0))
+        self.cells = {}
+        self.sizes = {}
+        self.free = []
+        self.next_cell = 0
+        self.files = []
+
+    def position(self, cell: int) -> tuple:
+        return (cell % self.columns) * self.CELL, (cell // self.columns) * self.CELL
+
+    def allocate(self) -> int:
+        if self.free:
+            return heappop(self.free)
+        cell = self.next_cell
+        self.next_cell = self.next_cell + 1
+        if self.position(cell)[1] + self.CELL > self.image.size[1]:
+            image = Image.new('RGBA', (self.image.size[0], self.image.size[1] * 2), (0, 0, 0, 0))
+            image.paste(self.image, (0, 0))
+            self.image = image
+        return cell
+
+    def update(self, avatars: set) -> Optional[dict]:
+        """Update the atlas to contain exactly the ``avatars`` (avatar URLs) and write it out, if it has changed.
+
+        Returns the atlas frame index, with the URL path of the image and the ``[x, y, width, height]`` of each
+        avatar, or ``None`` if none of the avatars exist.
+        """
+        changed = False
+        for avatar in set(self.cells) - avatars:
+            x, y = self.position(self.cells[avatar])
+            self.image.paste((0, 0, 0, 0), (x, y, x + self.CELL, y + self.CELL))
+            heappush(self.free, self.cells.pop(avatar))
+            del self.sizes[avatar]
+            changed = True
+        for avatar in avatars - set(self.cells):
+            try:
+                with Image.open(self.avatars.path(avatar.split('/')[-1], 'small')) as img:
+                    img.thumbnail((self.CELL, self.CELL))
+                    cell = self.allocate()
+                    self.image.paste(img, self.position(cell))
+                    self.cells[avatar] = cell
+                    self.sizes[avatar] = img.size
+                    changed = True
+            except OSError:
+                pass
+        if not self.cells:
+            return None
+        if changed or not self.files:
+            height = (max(self.cells.values()) // self.columns + 1) * self.CELL
+            out = BytesIO()
+            self.image.crop((0, 0, self.image.size[0], height)).save(out, format='PNG')
+            filename = f'{sha256(out.getvalue()).hexdigest()[:32]}.png'
+            write_file(os.path.join(self.directory, filename), out.getvalue())
+            if filename not in self.files:
+                self.files.append(filename)
+        return {
+            'url': f'{self.prefix}/{self.files[-1]}',
+            'frames': dict([(avatar, list(self.position(cell)) + list(self.sizes[avatar]))
+                            for avatar, cell in self.cells.items()])
+        }
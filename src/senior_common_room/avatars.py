@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import os
+
+from collections import OrderedDict
+from glob import glob
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+from time import monotonic
+from tornado.ioloop import IOLoop
+from typing import List, Optional
+
+from .images import ImageProcessor
+
+
+logger = logging.getLogger(__name__)
+
+SIZES = ('large', 'small')
+VARIANT_FORMATS = ('webp', 'png')
+
+
+def write_file(path: str, data: bytes):
+    """Write the data to the path atomically, via a temporary file in the same directory."""
+    with NamedTemporaryFile(dir=os.path.dirname(path), prefix='.', suffix='.tmp', delete=False) as out_f:
+        out_f.write(data)
+    os.chmod(out_f.name, 0o644)
+    os.replace(out_f.name, path)
+
+
+def read_file(path: str) -> bytes:
+    with open(path, 'rb') as in_f:
+        return in_f.read()
+
+
+def avatar_name(large: bytes, small: bytes) -> str:
+    return sha256(large + small).hexdigest()
+
+
+class AvatarStore():
+    """The avatar images in the avatar storage directory.
+
+    Avatars are named by the hash of their images, so that identical uploads share the same files and the content
+    behind an avatar URL never changes. The names of the existing avatars are indexed at startup and whenever an
+    avatar is written, so that checking for an avatar does not normally touch the filesystem. Avatars written by
+    other processes are added to the index when their ``user/{id}/avatar-updated`` message arrives, or otherwise
+    the first time they are checked. Names that are not found are remembered for ``missing_ttl`` seconds, so
+    repeated checks for a missing avatar do not touch the filesystem either.
+    """
+
+    def __init__(self, directory: str, missing_size: int = 1024, missing_ttl: int = 60):
+        self.directory = directory
+        self.missing = OrderedDict()
+        self.missing_size = missing_size
+        self.missing_ttl = missing_ttl
+        os.makedirs(self.directory, exist_ok=True)
+        files = set(os.listdir(self.directory))
+        self.index = set([filename[:-10] for filename in files
+                          if filename.endswith('-large.png') and f'{filename[:-10]}-small.png' in files])
+        logger.debug(f'Found {len(self.index)} avatars')
+
+    def path(self, name: str, size: str) -> str:
+        return os.path.join(self.directory, f'{name}-{size}.png')
+
+    async def start(self, mqtt):
+        await mqtt.subscribe('user/+/avatar-updated', self.on_avatar_updated)
+
+    def add(self, name: str):
+        self.index.add(name)
+        self.missing.pop(name, None)
+
+    def exists(self, name: Optional[str]) -> bool:
+        if name is None:
+            return False
+        if name in self.index:
+            return True
+        if name in self.missing:
+            if self.missing[name] > monotonic():
+                return False
+            del self.missing[name]
+        if all([os.path.exists(self.path(name, size)) for size in SIZES]):
+            self.add(name)
+            return True
+        self.missing[name] = monotonic() + self.missing_ttl
+        while len(self.missing) > self.missing_size:
+            self.missing.popitem(last=False)
+        return False
+
+    async def write(self, large: bytes, small: bytes) -> str:
+        """Store the two images of an avatar, unless identical ones exist already, and return the avatar's name."""
+        name = avatar_name(large, small)
+        if not self.exists(name):
+            await IOLoop.current().run_in_executor(None, self.write_files, name, large, small)
+            self.add(name)
+        return name
+
+    def write_files(self, name: str, large: bytes, small: bytes):
+        for size, data in zip(SIZES, (large, small)):
+            write_file(self.path(name, size), data)
+
+    async def on_avatar_updated(self, topic, message):
+        if message and message.get('avatar'):
+            self.add(message['avatar'])
+
+    def remove(self, name: str):
+        """Delete the images of the avatar and all its variants."""
+        self.index.discard(name)
+        paths = [self.path(name, size) for size in SIZES]
+        paths.extend(glob(os.path.join(self.directory, 'variants', f'{name}-*')))
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class VariantCache():
+    """Scaled WebP and PNG variants of the avatars, generated from the large image when first requested.
+
+    The variants are stored in the ``variants`` directory below the avatar directory. Once they take up more than
+    ``max_bytes``, the least recently requested ones are deleted, but the most recent one is always kept. Each
+    process only tracks the variants that exist at startup and those it has generated itself, so the limit applies
+    per process. A variant deleted by another process is generated again once it has been :meth:`discard`-ed.
+    """
+
+    def __init__(self, avatars: AvatarStore, images: ImageProcessor, sizes: List[int], max_bytes: int):
+        self.avatars = avatars
+        self.images = images
+        self.sizes = set(sizes)
+        self.max_bytes = max_bytes
+        self.directory = os.path.join(avatars.directory, 'variants')
+        os.makedirs(self.directory, exist_ok=True)
+        self.files = OrderedDict()
+        self.total = 0
+        self.pending = {}
+        with os.scandir(self.directory) as entries:
+            existing = [(entry.stat().st_mtime, entry.name, entry.stat().st_size) for entry in entries
+                        if entry.is_file() and not entry.name.startswith('.')]
+        for _, filename, size in sorted(existing):
+            self.files[filename] = size
+            self.total = self.total + size
+        self.evict()
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    async def get(self, name: str, size: int, format: str) -> Optional[str]:
+        """Return the filename of the variant, generating it if needed, or ``None`` if no such variant can exist."""
+        if size not in self.sizes or format not in VARIANT_FORMATS or not self.avatars.exists(name):
+            return None
+        filename = f'{name}-{size}.{format}'
+        if filename in self.files:
+            self.files.move_to_end(filename)
+            return filename
+        if filename not in self.pending:
+            self.pending[filename] = asyncio.ensure_future(self.generate(name, size, format, filename))
+            self.pending[filename].add_done_callback(lambda _: self.pending.pop(filename, None))
+        await asyncio.shield(self.pending[filename])
+        return filename
+
+    async def generate(self, name: str, size: int, format: str, filename: str):
+        loop = IOLoop.current()
+        data = await loop.run_in_executor(None, read_file, self.avatars.path(name, 'large'))
+        variant = await self.images.variant(data, size, format)
+        await loop.run_in_executor(None, write_file, self.path(filename), variant)
+        self.total = self.total - self.files.pop(filename, 0) + len(variant)
+        self.files[filename] = len(variant)
+        self.evict()
+
+    def discard(self, filename: str):
+        """Forget the variant, which no longer exists."""
+        self.total = self.total - self.files.pop(filename, 0)
+
+    def evict(self):
+        while self.total > self.max_bytes and len(self.files) > 1:
+            filename, size = self.files.popitem(last=False)
+            self.total = self.total - size
+            try:
+                os.unlink(self.path(filename))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,82 @@
+import logging
+
+from collections import OrderedDict
+from sqlalchemy.orm import make_transient_to_detached
+from time import monotonic
+from typing import Optional
+
+from . import codec, metrics
+from .models import User
+from .mqtt import MQTTClient
+
+
+logger = logging.getLogger(__name__)
+
+USER_COLUMNS = [column.key for column in User.__table__.columns]
+
+
+class UserCache():
+    """Process-wide LRU cache of the active users that have recently authenticated, keyed by e-mail and token.
+
+    Entries expire after ``ttl`` seconds. All entries of a user are dropped when ``user/{id}/updated`` or
+    ``user/{id}/reconnect`` is published, so every change to a user record must be followed by one of the two.
+    Each lookup returns a new detached :class:`User`, which the handler can then add to its own sessions. Hits,
+    misses and the number of entries are reported as the ``user_cache`` metrics.
+    """
+
+    def __init__(self, mqtt: MQTTClient, size: int, ttl: int):
+        self.mqtt = mqtt
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+        metrics.register('user_cache', lambda: {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries)
+        })
+
+    async def start(self):
+        await self.mqtt.subscribe('user/+/updated', self.on_user_changed)
+        await self.mqtt.subscribe('user/+/reconnect', self.on_user_changed)
+
+    def get(self, email: str, token: str) -> Optional[User]:
+        key = (email, token)
+        if key in self.entries:
+            expires, _, snapshot = self.entries[key]
+            if expires > monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                user = User(**codec.loads(snapshot))
+                make_transient_to_detached(user)
+                return user
+            self.remove(key)
+        self.misses += 1
+        return None
+
+    def put(self, email: str, token: str, user: User):
+        key = (email, token)
+        self.remove(key)
+        self.entries[key] = (monotonic() + self.ttl, user.id,
+                             codec.dumps(dict([(column, getattr(user, column)) for column in USER_COLUMNS])))
+        if user.id not in self.keys:
+            self.keys[user.id] = set()
+        self.keys[user.id].add(key)
+        while len(self.entries) > self.size:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key: tuple):
+        if key in self.entries:
+            _, user_id, _ = self.entries.pop(key)
+            self.keys[user_id].discard(key)
+            if len(self.keys[user_id]) == 0:
+                del self.keys[user_id]
+
+    def invalidate(self, user_id: int):
+        for key in list(self.keys.get(user_id, ())):
+            self.remove(key)
+
+    async def on_user_changed(self, topic, message):
+        self.invalidate(int(topic.split('/')[1]))
@@ -0,0 +1,30 @@
+# JSON encoding for WebSocket frames and MQTT payloads. Uses orjson if it is installed (the orjson extra) and the
+# standard library json module otherwise. Either way dumps returns UTF-8 encoded bytes.
+import json
+
+try:
+    import orjson
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    loads = orjson.loads
+except ImportError:
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+    loads = json.loads
+
+
+def canonical(obj) -> bytes:
+    """Encode the object with sorted keys and without escaping, always via the json module, so that hashes over the
+    result are the same on all nodes, whether or not they have orjson installed."""
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def frame(message_type: str, payload: bytes) -> bytes:
+    """Wrap an already encoded payload into a WebSocket message frame, without decoding it."""
+    if payload:
+        return b'{"type":' + dumps(message_type) + b',"payload":' + payload + b'}'
+    else:
+        return b'{"type":' + dumps(message_type) + b'}'
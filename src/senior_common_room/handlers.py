@@ -1,152 +1,260 @@
-import asyncio_mqtt
 import logging
-import json
+import re
 
+from collections import deque
+from PIL import Image
 from tornado.ioloop import IOLoop
+from tornado.web import HTTPError, RequestHandler, StaticFileHandler, stream_request_body
 from tornado.websocket import WebSocketHandler
 
+from . import codec
+from .api import DispatchMixin, handles_message
 from .api.config import ConfigMixin
 from .api.jitsi import JitsiMixin
 from .api.user import UserMixin
 from .api.room import RoomMixin
 from .api.messages import MessagesMixin
 from .api.admin import AdminMixin
-from .models import create_sessionmaker
+from .api.session import SessionMixin
+from .api.user import find_active_user, store_avatar
+from .images import ImageQueueFull
+from .outbound import CONTROL, OutboundQueue
 
 
 logger = logging.getLogger(__name__)
 
 
-class ApiHandler(WebSocketHandler, ConfigMixin, JitsiMixin, UserMixin, RoomMixin, MessagesMixin, AdminMixin):
+class ApiHandler(WebSocketHandler, DispatchMixin, ConfigMixin, JitsiMixin, UserMixin, RoomMixin, MessagesMixin,
+                 AdminMixin, SessionMixin):
 
-    def initialize(self, config):
+    def initialize(self, config, config_frames, schedule, sessionmaker, mqtt, movement, images, avatars, mail,
+                   user_cache, sessions, maps):
         self.config = config
-        self.sessionmaker = create_sessionmaker(config['database']['dsn'])
-        self.mqtt = asyncio_mqtt.Client(hostname=config['mosquitto'], port=1883)
+        self.config_frames = config_frames
+        self.schedule = schedule
+        self.sessionmaker = sessionmaker
+        self.mqtt = mqtt
+        self.movement = movement
+        self.images = images
+        self.avatars = avatars
+        self.mail = mail
+        self.user_cache = user_cache
+        self.sessions = sessions
+        self.maps = maps
+        self.mqtt_subscriptions = {}
         self.user = None
-        self.user_mqtt_task = None
-        self.room_mqtt_task = None
+        self.replay = deque(maxlen=config['server']['session_replay'])
+        self.outbound = OutboundQueue(self, config['server']['outbound_queue'],
+                                      config['server']['saturation_timeout'], self.close)
         logger.debug('Initialised')
 
     async def open(self):
         logger.debug('Opening websocket connection')
-        await self.mqtt.connect(timeout=5)
+        self.outbound.start()
+        self.mqtt.on_reconnect(self.on_mqtt_reconnect)
         await self.send_message({'type': 'authentication-required'})
-        await self.setup_messages_task()
-        await self.setup_admin_messages_task()
+        await self.subscribe_messages()
+        await self.subscribe_admin_messages()
         logger.debug('Websocket connection opened')
 
     def on_close(self):
         logger.debug('Websocket connection closed')
+        self.outbound.stop()
+        if not self.sessions.park(self):
+            self.teardown()
+
+    def teardown(self):
+        self.mqtt.remove_on_reconnect(self.on_mqtt_reconnect)
         IOLoop.current().add_callback(self.jitsi_shutdown)
-        if self.user_mqtt_task:
-            self.user_mqtt_task.cancel()
-        if self.room_mqtt_task:
-            self.room_mqtt_task.cancel()
-        self.teardown_messages_task()
-        self.teardown_admin_task()
         IOLoop.current().add_callback(self.teardown_room)
-        IOLoop.current().add_callback(self.mqtt.disconnect)
-
-    async def on_mqtt_messages(self, topic):
-        logger.debug(f'Listening to mqtt messages on {topic}')
-        async with self.mqtt.filtered_messages(topic) as messages:
-            await self.mqtt.subscribe(topic)
-            async for message in messages:
-                if message.topic == f'user/{self.user.id}/enter-jitsi-room' and 'jitsi' in self.config:
-                    await self.enter_jitsi_room(json.loads(message.payload.decode()))
-                elif message.topic.startswith('room/') and message.topic.endswith('/set-avatar-location'):
-                    await self.room_update_avatar_location(json.loads(message.payload.decode()))
-                elif message.topic.startswith('room/') and message.topic.endswith('/leave'):
-                    await self.room_remove_avatar(json.loads(message.payload.decode()))
-                elif message.topic == 'messages/broadcast':
-                    await self.receive_broadcast_message(json.loads(message.payload.decode()))
-                elif message.topic == f'user/{self.user.id}/message':
-                    await self.receive_user_message(json.loads(message.payload.decode()))
-                elif message.topic == f'user/{self.user.id}/request-video-chat':
-                    await self.receive_request_video_chat_message(json.loads(message.payload.decode()))
-                elif self.jitsi_room_name and message.topic == f'jitsi-rooms/{self.jitsi_room_name}/user-list':
-                    await self.jitsi_room_user_list(json.loads(message.payload.decode()))
-                elif self.jitsi_room_name and message.topic == f'user/{self.user.id}/leave_jitsi_room':
-                    await self.leave_jitsi_room()
-                elif message.topic == f'user/{self.user.id}/reconnect':
-                    self.close()
-                elif message.topic == 'messages/admin':
-                    await self.receive_ui_reload()
-                else:
-                    logger.debug(message.topic)
+        IOLoop.current().add_callback(self.mqtt_unsubscribe_all)
+
+    async def mqtt_subscribe(self, topic_filter, raw=False):
+        if topic_filter not in self.mqtt_subscriptions:
+            logger.debug(f'Listening to mqtt messages on {topic_filter}')
+            self.mqtt_subscriptions[topic_filter] = raw
+            await self.mqtt.subscribe(topic_filter, self.on_mqtt_message, raw=raw)
+
+    async def mqtt_unsubscribe(self, topic_filter):
+        if topic_filter in self.mqtt_subscriptions:
+            raw = self.mqtt_subscriptions.pop(topic_filter)
+            await self.mqtt.unsubscribe(topic_filter, self.on_mqtt_message, raw=raw)
+
+    async def mqtt_unsubscribe_all(self):
+        for topic_filter in list(self.mqtt_subscriptions):
+            await self.mqtt_unsubscribe(topic_filter)
+
+    async def on_mqtt_message(self, topic, message):
+        await self.dispatch_topic(topic, message)
+
+    async def on_mqtt_reconnect(self):
+        await self.room_announce_avatar()
+        await self.jitsi_announce()
 
     async def on_message(self, data):
         try:
-            message = json.loads(data)
-            if 'type' in message:
-                if message['type'] == 'authenticate':
-                    await self.authenticate(message)
-                elif message['type'] == 'get-core-config':
-                    await self.get_core_config()
-                elif message['type'] == 'get-rooms-config':
-                    await self.get_rooms_config()
-                elif message['type'] == 'get-badges-config':
-                    await self.get_badges_config()
-                elif message['type'] == 'get-timezones-config':
-                    await self.get_timezones_config()
-                elif message['type'] == 'get-schedule-config':
-                    await self.get_schedule_config()
-                elif message['type'] == 'get-links-config':
-                    await self.get_links_config()
-                elif message['type'] == 'get-user':
-                    await self.get_user(message)
-                elif message['type'] == 'update-user-profile':
-                    await self.update_user_profile(message)
-                elif message['type'] == 'update-avatar-image':
-                    await self.update_avatar_image(message)
-                elif message['type'] == 'enter-jitsi-room' and 'jitsi' in self.config:
-                    await self.request_jitsi_room(message)
-                elif message['type'] == 'leave-jitsi-room' and 'jitsi' in self.config:
-                    await self.leave_jitsi_room()
-                elif message['type'] == 'get-jitsi-room-users' and 'jitsi' in self.config:
-                    await self.request_jitsi_room_users()
-                elif message['type'] == 'enter-room':
-                    await self.enter_room(message)
-                elif message['type'] == 'set-avatar-location':
-                    await self.room_set_avatar_location(message)
-                elif message['type'] == 'leave-room':
-                    await self.leave_room(message)
-                elif message['type'] == 'user-message':
-                    await self.send_user_message(message)
-                elif message['type'] == 'request-video-chat-message':
-                    await self.send_request_video_chat_message(message)
-                elif message['type'] == 'request-join-video-chat-message':
-                    await self.send_request_join_video_chat_message(message)
-                elif message['type'] == 'accept-video-chat-message':
-                    await self.send_accept_video_chat_message(message)
-                elif message['type'] == 'block-user':
-                    await self.block_user(message)
-                elif message['type'] == 'unblock-user':
-                    await self.unblock_user(message)
-                elif message['type'] == 'broadcast-message':
-                    await self.send_broadcast_message(message)
-                elif message['type'] == 'admin-ui-reload':
-                    await self.send_ui_reload()
-                elif message['type'] == 'ping':
-                    pass
-                else:
-                    logger.debug(data)
-            else:
-                logger.debug(data)
-        except Exception as e:
-            logger.error(e)
+            message = codec.loads(data)
+        except ValueError:
+            logger.debug(data)
+            return
+        if isinstance(message, dict) and 'type' in message:
+            self.refresh_jitsi_lease()
+            await self.dispatch_message(message)
+        else:
+            logger.debug(data)
+
+    def on_pong(self, data):
+        self.refresh_jitsi_lease()
+
+    @handles_message('ping')
+    async def keepalive(self, message):
+        pass
 
+    async def send_message(self, msg, replay=False):
+        await self.send_frame(codec.dumps(msg), replay=replay)
 
-    async def send_message(self, msg):
-        await self.write_message(json.dumps(msg))
+    async def send_frame(self, frame, binary=False, kind=CONTROL, key=None, replay=False):
+        """Queue the frame for the client. While the handler is parked, frames sent with ``replay`` set are
+        buffered for the connection that resumes the session and all others are dropped."""
+        if self.parked:
+            if replay:
+                self.replay.append(frame)
+        else:
+            self.outbound.put(frame, binary=binary, kind=kind, key=key)
 
     async def send_mqtt_message(self, topic, msg=None):
         if msg:
-            await self.mqtt.publish(topic, payload=json.dumps(msg).encode())
+            await self.mqtt.publish(topic, payload=codec.dumps(msg))
         else:
             await self.mqtt.publish(topic)
 
     def check_origin(self, *args, **kwargs):
         # TODO: Enable only in dev mode
         return True
+
+
+@stream_request_body
+class AvatarUploadHandler(RequestHandler):
+    """Accepts a PNG or JPEG avatar image as the raw request body.
+
+    The user is authenticated from the ``X-Email`` and ``X-Token`` headers and the size limit is checked before
+    any of the body is read. Once the avatar is stored, the user's WebSocket handlers are told over MQTT.
+    """
+
+    FORMATS = {'image/png': 'PNG', 'image/jpeg': 'JPEG'}
+
+    def initialize(self, config, sessionmaker, mqtt, images, avatars, user_cache):
+        self.config = config
+        self.sessionmaker = sessionmaker
+        self.mqtt = mqtt
+        self.images = images
+        self.avatars = avatars
+        self.user_cache = user_cache
+        self.limit = config['images']['max_upload']
+        self.user = None
+        self.body = bytearray()
+
+    async def prepare(self):
+        if self.request.method != 'POST':
+            return
+        if self.request.headers.get('Content-Type') not in self.FORMATS:
+            self.send_error(415)
+        elif int(self.request.headers.get('Content-Length', 0)) > self.limit:
+            self.send_error(413)
+        else:
+            self.user = await find_active_user(self.sessionmaker, self.user_cache,
+                                               self.request.headers.get('X-Email', ''),
+                                               self.request.headers.get('X-Token', ''))
+            if self.user is None:
+                self.send_error(403)
+            else:
+                self.request.connection.set_max_body_size(self.limit)
+
+    def data_received(self, chunk):
+        self.body.extend(chunk)
+
+    async def post(self):
+        try:
+            large, small = await self.images.avatar(self.body, self.FORMATS[self.request.headers['Content-Type']])
+        except ImageQueueFull:
+            logger.warning('Image processing queue full')
+            self.send_error(503)
+            return
+        except (OSError, ValueError, Image.DecompressionBombError):
+            logger.debug('Invalid avatar image')
+            self.send_error(400)
+            return
+        await store_avatar(self.sessionmaker, self.avatars, self.user, large, small)
+        await self.mqtt.publish(f'user/{self.user.id}/updated')
+        await self.mqtt.publish(f'user/{self.user.id}/avatar-updated', payload=codec.dumps({
+            'avatar': self.user.avatar
+        }))
+        self.set_header('Content-Type', 'application/json')
+        self.finish(codec.dumps({
+            'avatar': f'{self.config["server"]["prefixes"]["avatars"]}/{self.user.avatar}'
+        }))
+
+
+class AvatarVariantHandler(StaticFileHandler):
+    """Serves the avatar variants as ``{avatar}-{size}.{webp|png}``, generating them on first request.
+
+    Avatar names are content hashes, or random names for avatars stored before that, so a variant never changes
+    and may be cached forever. Clients build the variant URLs from ``server.prefixes.variants``, which must be the
+    public URL of this handler.
+    """
+
+    PATTERN = re.compile(r'([0-9a-f]{64}|[0-9a-f]{32})-([0-9]+)\.(webp|png)')
+
+    def initialize(self, variants):
+        super().initialize(variants.directory)
+        self.variants = variants
+
+    async def get(self, path, include_body=True):
+        match = self.PATTERN.fullmatch(path)
+        if match is None:
+            raise HTTPError(404)
+        for attempt in range(2):
+            try:
+                filename = await self.variants.get(match.group(1), int(match.group(2)), match.group(3))
+            except ImageQueueFull:
+                raise HTTPError(503)
+            if filename is None:
+                raise HTTPError(404)
+            try:
+                await super().get(filename, include_body)
+                return
+            except HTTPError as e:
+                if e.status_code != 404 or attempt > 0:
+                    raise
+                self.variants.discard(filename)
+
+    def get_content_type(self):
+        return 'image/webp' if self.absolute_path.endswith('.webp') else 'image/png'
+
+    def set_extra_headers(self, path):
+        self.set_header('Cache-Control', 'public, max-age=31536000, immutable')
+
+
+class AtlasHandler(StaticFileHandler):
+    """Serves the room avatar atlases. Atlases are named by their content hash and may be cached forever."""
+
+    def set_extra_headers(self, path):
+        self.set_header('Cache-Control', 'public, max-age=31536000, immutable')
+
+
+class MapHandler(RequestHandler):
+    """Serves the compiled room maps. Clients revalidate them using the map version as the ETag."""
+
+    def initialize(self, maps):
+        self.maps = maps
+
+    def get(self, slug):
+        self.compiled_map = self.maps.get(slug)
+        if self.compiled_map is None:
+            raise HTTPError(404)
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(self.compiled_map.frame)
+
+    def compute_etag(self):
+        return f'"{self.compiled_map.version}"'
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageOps
+from typing import Tuple
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImageQueueFull(Exception):
+    pass
+
+
+def process_avatar_image(data: bytes, format: str, max_resolution: int) -> Tuple[bytes, bytes]:
+    """Crop the image to a circle and return the large (at most ``max_resolution`` square) and small (48x48)
+    avatar PNGs.
+
+    Runs in a worker process of the :class:`ImageProcessor`.
+    """
+    img = Image.open(BytesIO(data), formats=[format])
+    if img.size[0] != img.size[1]:
+        if img.size[0] < img.size[1]:
+            img = ImageOps.fit(img, (img.size[0], img.size[0]), centering=(0.5, 0.5))
+        else:
+            img = ImageOps.fit(img, (img.size[1], img.size[1]), centering=(0.5, 0.5))
+    img.thumbnail((max_resolution, max_resolution), Image.Resampling.LANCZOS)
+    mask = Image.new('L', img.size, 0)
+    draw = ImageDraw.Draw(mask)
+    draw.ellipse((0, 0) + img.size, fill=255)
+    img.putalpha(mask)
+    large = BytesIO()
+    img.save(large, format='PNG')
+    img.thumbnail((48, 48))
+    small = BytesIO()
+    img.save(small, format='PNG')
+    return large.getvalue(), small.getvalue()
+
+
+def process_avatar_variant(data: bytes, size: int, format: str) -> bytes:
+    """Scale the large avatar PNG down to ``size`` and return it as ``webp`` or ``png``.
+
+    Runs in a worker process of the :class:`ImageProcessor`.
+    """
+    img = Image.open(BytesIO(data), formats=['PNG'])
+    if img.size[0] > size:
+        img = img.resize((size, size), Image.Resampling.LANCZOS)
+    out = BytesIO()
+    if format == 'webp':
+        img.save(out, format='WEBP', quality=85, method=4)
+    else:
+        img.save(out, format='PNG', optimize=True)
+    return out.getvalue()
+
+
+class ImageProcessor():
+    """Runs image processing in a process pool, so that large uploads do not block the IOLoop.
+
+    At most ``concurrency`` images are processed at the same time. If no slot is free, requests wait for one,
+    unless ``queue_size`` requests are already waiting, in which case :class:`ImageQueueFull` is raised. The queue depth
+    is reported as the ``images`` metrics.
+    """
+
+    def __init__(self, workers: int, concurrency: int, queue_size: int, max_resolution: int):
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.queue_size = queue_size
+        self.max_resolution = max_resolution
+        self.waiting = 0
+        self.active = 0
+        self.peak_depth = 0
+        self.rejected = 0
+        metrics.register('images', self.metrics)
+
+    @property
+    def queue_depth(self) -> int:
+        return self.waiting + self.active
+
+    def metrics(self) -> dict:
+        return {
+            'queue_depth': self.queue_depth,
+            'waiting': self.waiting,
+            'active': self.active,
+            'peak_depth': self.peak_depth,
+            'rejected': self.rejected
+        }
+
+    async def avatar(self, data: bytes, format: str) -> Tuple[bytes, bytes]:
+        return await self.run(process_avatar_image, data, format, self.max_resolution)
+
+    async def variant(self, data: bytes, size: int, format: str) -> bytes:
+        return await self.run(process_avatar_variant, data, size, format)
+
+    async def run(self, func, *args):
+        if self.semaphore.locked() and self.waiting >= self.queue_size:
+            self.rejected += 1
+            raise ImageQueueFull()
+        self.waiting += 1
+        self.peak_depth = max(self.peak_depth, self.queue_depth)
+        logger.debug(f'Image processing queue depth {self.queue_depth}')
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
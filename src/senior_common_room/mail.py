@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+import smtplib
+
+from email.message import EmailMessage
+from secrets import token_hex
+
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPTransport():
+    """Sends e-mails via a single SMTP connection, which is opened on demand and then re-used."""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.smtp = None
+
+    def send(self, email: EmailMessage):
+        if self.smtp is None:
+            smtp = smtplib.SMTP(self.config['server'], timeout=30)
+            if self.config['secure']:
+                smtp.starttls()
+            if self.config['authentication']:
+                smtp.login(self.config['authentication']['username'], self.config['authentication']['password'])
+            self.smtp = smtp
+        try:
+            self.smtp.send_message(email)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self.close()
+            raise
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+
+class FileTransport():
+    """Writes each e-mail into the configured directory, for testing."""
+
+    def __init__(self, config: dict):
+        self.directory = config['directory']
+
+    def send(self, email: EmailMessage):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, f'{token_hex(8)}.eml'), 'wb') as out_f:
+            out_f.write(email.as_bytes())
+
+    def close(self):
+        pass
+
+
+class LogTransport():
+    """Logs each e-mail, for testing."""
+
+    def __init__(self, config: dict):
+        pass
+
+    def send(self, email: EmailMessage):
+        logger.info(f'E-mail to {email["To"]}\n\n{email.get_content()}')
+
+    def close(self):
+        pass
+
+
+TRANSPORTS = {
+    'smtp': SMTPTransport,
+    'file': FileTransport,
+    'log': LogTransport,
+}
+
+
+class MailQueue():
+    """Bounded queue of outgoing e-mails, delivered in the background by a fixed number of workers.
+
+    Each worker owns one transport and runs the blocking delivery in a thread, so SMTP connections are re-used
+    across e-mails and closed again once the queue has been idle for ``idle_timeout`` seconds. Failed deliveries
+    are retried with exponential backoff.
+    """
+
+    def __init__(self, config: dict, idle_timeout: int = 60):
+        self.config = config
+        self.queue = asyncio.Queue(maxsize=config['queue_size'])
+        self.idle_timeout = idle_timeout
+        self.workers = []
+
+    def start(self):
+        for _ in range(self.config['workers']):
+            self.workers.append(asyncio.create_task(self.worker(TRANSPORTS[self.config['sink']](self.config))))
+
+    async def stop(self, timeout: int = 10):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'Discarding {self.queue.qsize()} undelivered e-mails')
+        for worker in self.workers:
+            worker.cancel()
+
+    def send(self, email: EmailMessage) -> bool:
+        """Queue the e-mail for delivery. Returns ``False`` if the queue is full."""
+        try:
+            self.queue.put_nowait(email)
+            return True
+        except asyncio.QueueFull:
+            logger.warning('E-mail queue full')
+            return False
+
+    async def worker(self, transport):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    email = await asyncio.wait_for(self.queue.get(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    await loop.run_in_executor(None, transport.close)
+                    continue
+                try:
+                    for attempt in range(self.config['retries'] + 1):
+                        try:
+                            await loop.run_in_executor(None, transport.send, email)
+                            break
+                        except (smtplib.SMTPException, OSError) as e:
+                            await loop.run_in_executor(None, transport.close)
+                            if attempt < self.config['retries']:
+                                logger.warning(f'Failed to send e-mail to {email["To"]} ({e}), retrying')
+                                await asyncio.sleep(self.config['retry_delay'] * 2 ** attempt)
+                            else:
+                                logger.error(f'Failed to send e-mail to {email["To"]} ({e})')
+                except Exception as e:
+                    logger.exception(f'Failed to send e-mail ({e})')
+                finally:
+                    self.queue.task_done()
+        finally:
+            loop.run_in_executor(None, transport.close)
@@ -0,0 +1,173 @@
+import logging
+import os
+
+from base64 import b64decode, b64encode
+from hashlib import sha256
+from typing import Dict, List, Optional
+
+from . import codec
+
+
+logger = logging.getLogger(__name__)
+
+GID_MASK = 0x1FFFFFFF
+
+
+def pack_bits(width: int, height: int, tiles: set) -> str:
+    """Pack the set of ``(x, y)`` tiles into a row-major bitmap, least significant bit first, encoded as base64."""
+    bitmap = bytearray((width * height + 7) // 8)
+    for x, y in tiles:
+        idx = y * width + x
+        bitmap[idx >> 3] = bitmap[idx >> 3] | (1 << (idx & 7))
+    return b64encode(bytes(bitmap)).decode()
+
+
+def layer_properties(layer: dict) -> dict:
+    return dict([(prop['name'], prop['value']) for prop in layer.get('properties', []) if prop])
+
+
+def tile_layers(layers: list, prefix: str = '') -> List[dict]:
+    """Flatten the tile layers of the map, naming the layers within groups ``{group}/{layer}`` as Phaser does."""
+    result = []
+    for layer in layers:
+        if layer['type'] == 'group':
+            result.extend(tile_layers(layer.get('layers', []), f'{prefix}{layer["name"]}/'))
+        elif layer['type'] == 'tilelayer':
+            result.append(dict(layer, name=f'{prefix}{layer["name"]}'))
+    return result
+
+
+def layer_tiles(layer: dict, width: int) -> Dict[tuple, int]:
+    """Return the non-empty tiles of the layer as a mapping of ``(x, y)`` to their gid."""
+    data = layer.get('data', [])
+    if layer.get('encoding') == 'base64':
+        if layer.get('compression'):
+            raise ValueError(f'Layer {layer["name"]} uses unsupported {layer["compression"]} compression')
+        raw = b64decode(data)
+        data = [int.from_bytes(raw[idx:idx + 4], 'little') for idx in range(0, len(raw), 4)]
+    return dict([((idx % width, idx // width), gid & GID_MASK) for idx, gid in enumerate(data) if gid & GID_MASK])
+
+
+def switch_room_targets(tiled: dict) -> List[tuple]:
+    """Return the ``(room, layer)`` pairs that the switchRoom actions of the map lead to."""
+    targets = []
+    for layer in tile_layers(tiled.get('layers', [])):
+        properties = layer_properties(layer)
+        if properties.get('action') == 'switchRoom' and properties.get('targetLayer'):
+            targets.append((properties.get('roomSlug'), properties['targetLayer']))
+    return targets
+
+
+def compile_map(slug: str, tiled: dict, targets: set) -> dict:
+    """Compile a Tiled JSON map into the tile grids needed to move around it.
+
+    The result has a ``collision`` bitmap of all tiles covered by a colliding layer or tile, a bitmap of the tiles
+    of each action layer and the list of tiles of each layer that avatars can be placed on: the starting layers and
+    the ``targets`` of switchRoom actions in other maps. ``start`` is the first starting layer.
+    """
+    if tiled.get('infinite'):
+        raise ValueError(f'Map {slug} is infinite')
+    width = tiled['width']
+    height = tiled['height']
+    colliding_gids = set()
+    for tileset in tiled.get('tilesets', []):
+        for tile in tileset.get('tiles', []):
+            if any([prop['name'] == 'collides' and prop['value'] for prop in tile.get('properties', [])]):
+                colliding_gids.add(tileset['firstgid'] + tile['id'])
+    collision = set()
+    actions = []
+    spawns = {}
+    start = None
+    for layer in tile_layers(tiled.get('layers', [])):
+        properties = layer_properties(layer)
+        tiles = layer_tiles(layer, width)
+        if properties.get('collides'):
+            collision.update(tiles)
+        else:
+            collision.update([coords for coords, gid in tiles.items() if gid in colliding_gids])
+        if properties.get('action'):
+            actions.append({
+                'layer': layer['name'],
+                'properties': properties,
+                'tiles': pack_bits(width, height, tiles)
+            })
+        if properties.get('starting') or layer['name'] in targets:
+            spawns[layer['name']] = sorted(tiles)
+            if properties.get('starting') and start is None:
+                start = layer['name']
+    return {
+        'room': slug,
+        'width': width,
+        'height': height,
+        'start': start,
+        'collision': pack_bits(width, height, collision),
+        'actions': actions,
+        'spawns': dict([(name, [list(coords) for coords in tiles]) for name, tiles in spawns.items()])
+    }
+
+
+def compile_maps(rooms: list) -> Dict[str, dict]:
+    """Compile the maps of all rooms that have a ``mapFile``. Raises an exception if any map cannot be compiled."""
+    sources = {}
+    for room in rooms:
+        if room.get('mapFile'):
+            with open(room['mapFile'], 'rb') as in_f:
+                sources[room['slug']] = codec.loads(in_f.read())
+    targets = {}
+    for tiled in sources.values():
+        for slug, layer in switch_room_targets(tiled):
+            targets.setdefault(slug, set()).add(layer)
+    return dict([(slug, compile_map(slug, tiled, targets.get(slug, set()))) for slug, tiled in sources.items()])
+
+
+class CompiledMap():
+    """A compiled map and its serialised form, which is versioned by its hash."""
+
+    def __init__(self, compiled: dict):
+        self.width = compiled['width']
+        self.height = compiled['height']
+        self.collision = b64decode(compiled['collision'])
+        self.frame = codec.dumps(compiled)
+        self.version = sha256(self.frame).hexdigest()[:16]
+
+    def allows(self, x, y) -> bool:
+        """Check whether an avatar may stand on the tile."""
+        if not isinstance(x, int) or not isinstance(y, int) or not (0 <= x < self.width and 0 <= y < self.height):
+            return False
+        idx = y * self.width + x
+        return not self.collision[idx >> 3] & (1 << (idx & 7))
+
+
+class MapIndex():
+    """The compiled maps of the rooms.
+
+    The maps are compiled from the rooms' ``mapFile`` at startup. If a map file is not available, the map compiled by
+    ``maps compile`` into ``storage.maps`` is used instead. Rooms without a compiled map are not validated.
+    """
+
+    def __init__(self, config: dict):
+        self.maps = {}
+        directory = config['storage'].get('maps')
+        available = [room for room in config['rooms'] if room.get('mapFile') and os.path.exists(room['mapFile'])]
+        try:
+            compiled = compile_maps(available)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f'Failed to compile the room maps: {e}')
+            compiled = {}
+        for room in config['rooms']:
+            if room['slug'] not in compiled and directory:
+                path = os.path.join(directory, f'{room["slug"]}.json')
+                if os.path.exists(path):
+                    with open(path, 'rb') as in_f:
+                        compiled[room['slug']] = codec.loads(in_f.read())
+            if room['slug'] in compiled:
+                self.maps[room['slug']] = CompiledMap(compiled[room['slug']])
+        logger.debug(f'Compiled {len(self.maps)} room maps')
+
+    def get(self, slug: str) -> Optional[CompiledMap]:
+        return self.maps.get(slug)
+
+    def allows(self, slug: str, x, y) -> bool:
+        if slug in self.maps:
+            return self.maps[slug].allows(x, y)
+        return True
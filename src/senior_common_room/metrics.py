@@ -0,0 +1,30 @@
+import logging
+
+from tornado.ioloop import PeriodicCallback
+from typing import Callable
+
+from . import codec
+
+
+logger = logging.getLogger(__name__)
+
+sources = {}
+
+
+def register(name: str, source: Callable[[], dict]):
+    """Register a function that returns the current values of a group of metrics of this process."""
+    sources[name] = source
+
+
+def snapshot() -> dict:
+    return dict([(name, source()) for name, source in sources.items()])
+
+
+def log_metrics():
+    logger.info(f'Metrics {codec.dumps(snapshot()).decode()}')
+
+
+def start_metrics_log(interval: int):
+    """Log the metrics of this process every ``interval`` seconds. Disabled if ``interval`` is 0."""
+    if interval > 0:
+        PeriodicCallback(log_metrics, interval * 1000).start()
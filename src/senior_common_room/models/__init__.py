@@ -1,24 +1,54 @@
 import logging
 
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from typing import Union
 
 from .meta import Base  # noqa
 from .user import User  # noqa
+from . import migrations  # noqa
 
 
 logger = logging.getLogger(__name__)
 
+engines = {}
 
-def create_engine(dsn: str):
+
+def create_engine(dsn: str, **kwargs):
     logger.debug(f'Creating engine for {dsn}')
-    return create_async_engine(dsn)
+    return create_async_engine(dsn, **kwargs)
 
 
-def create_sessionmaker(dsn: str):
+def create_sessionmaker(engine: Union[str, AsyncEngine]):
     logger.debug('Creating sessionmaker')
+    if isinstance(engine, str):
+        engine = create_engine(engine)
     return sessionmaker(
-        create_engine(dsn),
+        engine,
         expire_on_commit=False,
         class_=AsyncSession
     )
+
+
+def setup_engine(config: dict) -> AsyncEngine:
+    """Return the process-wide engine for the configured database, creating it on first use."""
+    dsn = config['database']['dsn']
+    if dsn not in engines:
+        kwargs = {
+            'pool_pre_ping': config['database']['pool_pre_ping'],
+            'pool_recycle': config['database']['pool_recycle'],
+        }
+        if not dsn.startswith('sqlite'):
+            # SQLite uses a NullPool / StaticPool, which do not support sizing
+            kwargs['pool_size'] = config['database']['pool_size']
+            kwargs['max_overflow'] = config['database']['max_overflow']
+        engines[dsn] = create_engine(dsn, **kwargs)
+    return engines[dsn]
+
+
+async def dispose_engines():
+    """Close all pooled connections of the process-wide engines."""
+    while engines:
+        dsn, engine = engines.popitem()
+        logger.debug(f'Disposing engine for {dsn}')
+        await engine.dispose()
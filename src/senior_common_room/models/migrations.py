@@ -0,0 +1,124 @@
+import logging
+
+from sqlalchemy import Column, Integer, MetaData, Table, UniqueConstraint, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.schema import CreateIndex, CreateTable, DropIndex
+from typing import Optional
+
+from .meta import NAMING_CONVENTION, metadata
+from .user import User
+
+
+logger = logging.getLogger(__name__)
+
+schema_version = Table('schema_version', metadata, Column('version', Integer, nullable=False))
+
+
+def index(name):
+    return [idx for idx in User.__table__.indexes if idx.name == name][0]
+
+
+def create_indexes(*names):
+    def upgrade(conn):
+        for name in names:
+            conn.execute(CreateIndex(index(name), if_not_exists=True))
+    return upgrade
+
+
+def drop_indexes(*names):
+    def downgrade(conn):
+        for name in names:
+            conn.execute(DropIndex(index(name), if_exists=True))
+    return downgrade
+
+
+def rebuild_sqlite_table(conn, table: Table):
+    """Recreate the table from ``table``, which SQLite needs for any change to its constraints, keeping its rows
+    and indexes."""
+    columns = ', '.join([column.name for column in table.columns])
+    conn.execute(text(f'ALTER TABLE {table.name} RENAME TO {table.name}_rebuild'))
+    conn.execute(CreateTable(table))
+    conn.execute(text(f'INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {table.name}_rebuild'))
+    conn.execute(text(f'DROP TABLE {table.name}_rebuild'))
+    for idx in table.indexes:
+        conn.execute(CreateIndex(idx, if_not_exists=True))
+
+
+def avatar_unique(unique: bool):
+    def migrate(conn):
+        if conn.dialect.name == 'sqlite':
+            table = User.__table__.to_metadata(MetaData(naming_convention=NAMING_CONVENTION))
+            if unique:
+                table.append_constraint(UniqueConstraint(table.c.avatar, name='uq_users_avatar'))
+            rebuild_sqlite_table(conn, table)
+        elif unique:
+            conn.execute(text('ALTER TABLE users ADD CONSTRAINT uq_users_avatar UNIQUE (avatar)'))
+        else:
+            conn.execute(text('ALTER TABLE users DROP CONSTRAINT IF EXISTS uq_users_avatar'))
+    return migrate
+
+
+# Each migration is a (description, upgrade, downgrade) tuple. The schema version is the number of applied
+# migrations. Upgrade and downgrade functions are run with a synchronous connection.
+MIGRATIONS = [
+    ('Add indexes for the login lookup',
+     create_indexes('ix_users_token', 'ix_users_lower_email', 'ix_users_active_login'),
+     drop_indexes('ix_users_token', 'ix_users_lower_email', 'ix_users_active_login')),
+    ('Allow users to share content-addressed avatars',
+     avatar_unique(False),
+     avatar_unique(True)),
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def get_version(conn) -> int:
+    if not inspect(conn).has_table('schema_version'):
+        schema_version.create(conn)
+    version = conn.execute(select(schema_version.c.version)).scalar()
+    if version is None:
+        conn.execute(schema_version.insert().values(version=0))
+        version = 0
+    return version
+
+
+def set_version(conn, version: int):
+    conn.execute(schema_version.update().values(version=version))
+
+
+async def stamp(engine: AsyncEngine, version: int = LATEST_VERSION):
+    """Record the schema as being at ``version``, without running any migrations."""
+    async with engine.begin() as conn:
+        await conn.run_sync(get_version)
+        await conn.run_sync(set_version, version)
+
+
+async def upgrade(engine: AsyncEngine, target: int = LATEST_VERSION) -> int:
+    """Apply all migrations up to ``target``, each in its own transaction. Returns the new schema version."""
+    async with engine.begin() as conn:
+        version = await conn.run_sync(get_version)
+    while version < target:
+        description, forward, _ = MIGRATIONS[version]
+        logger.info(f'Upgrading to version {version + 1}: {description}')
+        async with engine.begin() as conn:
+            await conn.run_sync(forward)
+            await conn.run_sync(set_version, version + 1)
+        version = version + 1
+    return version
+
+
+async def downgrade(engine: AsyncEngine, target: Optional[int] = None) -> int:
+    """Revert all migrations down to ``target`` (by default only the last one), each in its own transaction.
+    Returns the new schema version."""
+    async with engine.begin() as conn:
+        version = await conn.run_sync(get_version)
+    if target is None:
+        target = max(version - 1, 0)
+    while version > target:
+        description, _, backward = MIGRATIONS[version - 1]
+        logger.info(f'Downgrading from version {version}: {description}')
+        async with engine.begin() as conn:
+            await conn.run_sync(backward)
+            await conn.run_sync(set_version, version - 1)
+        version = version - 1
+    return version
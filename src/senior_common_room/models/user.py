@@ -1,4 +1,4 @@
-from sqlalchemy import (Column, Integer, String)
+from sqlalchemy import (Column, Index, Integer, String, func)
 from sqlalchemy_json import NestedMutableJson
 
 from .meta import Base
@@ -12,8 +12,15 @@ class User(Base):
     email = Column(String(length=255), unique=True)
     name = Column(String(length=255))
     token = Column(String(length=255))
-    avatar = Column(String(length=255), unique=True)
+    avatar = Column(String(length=255))
     timezone = Column(String(length=255))
     roles = Column(NestedMutableJson)
     blocked_users = Column(NestedMutableJson)
     status = Column(String(length=255))
+
+
+Index('ix_users_token', User.token)
+Index('ix_users_lower_email', func.lower(User.email))
+Index('ix_users_active_login', func.lower(User.email), User.token,
+      postgresql_where=User.status == 'active',
+      sqlite_where=User.status == 'active')
@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import struct
+
+from functools import cached_property
+from tornado.ioloop import PeriodicCallback
+from typing import Optional
+
+from . import codec
+from .mqtt import MQTTClient
+
+
+logger = logging.getLogger(__name__)
+
+BINARY_AVATAR_LOCATIONS = 1
+BINARY_HEADER = struct.Struct('<B')
+BINARY_LOCATION = struct.Struct('<Ihh')
+COORDINATE_RANGE = range(-32768, 32768)
+
+
+def valid_location(x, y) -> bool:
+    """Check that the location can be encoded in the binary format, whose coordinates are int16."""
+    return all([isinstance(value, int) and not isinstance(value, bool) and value in COORDINATE_RANGE
+                for value in (x, y)])
+
+
+class SpatialGrid():
+    """Uniform grid over tile coordinates that buckets users into square cells of ``cell_size`` tiles."""
+
+    def __init__(self, cell_size: int):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.positions = {}
+
+    def cell(self, x: int, y: int) -> tuple:
+        return (x // self.cell_size, y // self.cell_size)
+
+    def move(self, user_id: int, x: int, y: int):
+        if user_id in self.positions:
+            old_cell = self.cell(*self.positions[user_id])
+            if old_cell == self.cell(x, y):
+                self.positions[user_id] = (x, y)
+                return
+            self.remove(user_id)
+        self.positions[user_id] = (x, y)
+        cell = self.cell(x, y)
+        if cell not in self.cells:
+            self.cells[cell] = set()
+        self.cells[cell].add(user_id)
+
+    def remove(self, user_id: int):
+        if user_id in self.positions:
+            cell = self.cell(*self.positions.pop(user_id))
+            self.cells[cell].discard(user_id)
+            if len(self.cells[cell]) == 0:
+                del self.cells[cell]
+
+    def query(self, x: int, y: int, radius: int) -> set:
+        """Return the users within ``radius`` tiles (Chebyshev distance) of the given location."""
+        min_x, min_y = self.cell(x - radius, y - radius)
+        max_x, max_y = self.cell(x + radius, y + radius)
+        result = set()
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                for user_id in self.cells.get((cell_x, cell_y), ()):
+                    user_x, user_y = self.positions[user_id]
+                    if abs(user_x - x) <= radius and abs(user_y - y) <= radius:
+                        result.add(user_id)
+        return result
+
+
+class RoomMovement():
+
+    def __init__(self, radius: Optional[int] = None):
+        self.handlers = set()
+        self.announced = {}
+        self.pending = {}
+        self.radius = radius
+        self.grid = SpatialGrid(radius) if radius else None
+        self.visible = {}
+
+
+class AvatarLocations():
+    """One tick worth of movement in a room.
+
+    Users that entered the room during the tick are sent with their full identity, everything else only as
+    ``[user_id, x, y]``. Each wire format is encoded at most once, however many handlers receive the batch.
+
+    The binary format is a one byte message type, followed by one little-endian ``uint32 user_id, int16 x,
+    int16 y`` record per location.
+    """
+
+    def __init__(self, room_name: str, users: list, locations: list):
+        self.room_name = room_name
+        self.users = users
+        self.locations = locations
+
+    def merge(self, other: 'AvatarLocations') -> 'AvatarLocations':
+        """Combine the locations of this batch with those of the later ``other`` batch, keeping the latest location
+        per user."""
+        locations = dict([(location[0], location) for location in self.locations + other.locations])
+        return AvatarLocations(self.room_name, self.users + other.users, list(locations.values()))
+
+    @cached_property
+    def user_ids(self) -> set:
+        return set([user['id'] for user in self.users] + [location[0] for location in self.locations])
+
+    @cached_property
+    def json_frame(self) -> bytes:
+        return codec.dumps({
+            'type': 'avatar-locations',
+            'payload': {
+                'room': self.room_name,
+                'users': self.users,
+                'locations': self.locations
+            }
+        })
+
+    @cached_property
+    def users_frame(self) -> bytes:
+        return codec.dumps({
+            'type': 'avatar-locations',
+            'payload': {
+                'room': self.room_name,
+                'users': self.users,
+                'locations': []
+            }
+        })
+
+    @cached_property
+    def binary_frame(self) -> bytes:
+        buffer = bytearray(BINARY_HEADER.size + BINARY_LOCATION.size * len(self.locations))
+        BINARY_HEADER.pack_into(buffer, 0, BINARY_AVATAR_LOCATIONS)
+        for idx, (user_id, x, y) in enumerate(self.locations):
+            BINARY_LOCATION.pack_into(buffer, BINARY_HEADER.size + BINARY_LOCATION.size * idx, user_id, x, y)
+        return bytes(buffer)
+
+
+class MovementAggregator():
+    """Batches avatar movement per room.
+
+    There is one aggregator per server process. It holds the room subscriptions on behalf of all local handlers
+    in that room, keeps only the last location per user within a tick and then sends each handler a single
+    :class:`AvatarLocations` batch per tick.
+
+    For rooms with an ``interest_radius`` the locations are indexed in a :class:`SpatialGrid` and each handler
+    only receives the movement of users within that radius of its own avatar, plus the current location of users
+    that have just come into range.
+    """
+
+    def __init__(self, mqtt: MQTTClient, tick: int, rooms: list):
+        self.mqtt = mqtt
+        self.radii = dict([(room['slug'], room['interest_radius']) for room in rooms])
+        self.rooms = {}
+        self.tasks = set()
+        self.timer = PeriodicCallback(self.flush, tick)
+
+    def start(self):
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    async def join(self, room_name: str, handler):
+        if room_name not in self.rooms:
+            self.rooms[room_name] = RoomMovement(self.radii.get(room_name))
+            await self.mqtt.subscribe(f'room/{room_name}/enter', self.on_enter)
+            await self.mqtt.subscribe(f'room/{room_name}/set-avatar-location', self.on_set_avatar_location)
+            await self.mqtt.subscribe(f'room/{room_name}/leave', self.on_leave)
+        self.rooms[room_name].handlers.add(handler)
+
+    async def leave(self, room_name: str, handler):
+        if room_name in self.rooms:
+            self.rooms[room_name].handlers.discard(handler)
+            self.rooms[room_name].visible.pop(handler, None)
+            if len(self.rooms[room_name].handlers) == 0:
+                del self.rooms[room_name]
+                await self.mqtt.unsubscribe(f'room/{room_name}/enter', self.on_enter)
+                await self.mqtt.unsubscribe(f'room/{room_name}/set-avatar-location', self.on_set_avatar_location)
+                await self.mqtt.unsubscribe(f'room/{room_name}/leave', self.on_leave)
+
+    def seed(self, room_name: str, avatars: list):
+        """Add the locations from a room snapshot for users that this process has not seen move yet."""
+        if room_name in self.rooms and self.rooms[room_name].grid:
+            grid = self.rooms[room_name].grid
+            for avatar in avatars:
+                if avatar['user']['id'] not in grid.positions and avatar['x'] is not None:
+                    grid.move(avatar['user']['id'], avatar['x'], avatar['y'])
+
+    async def on_enter(self, topic, message):
+        room_name = topic.split('/')[1]
+        if room_name in self.rooms:
+            self.rooms[room_name].announced[message['user']['id']] = message['user']
+
+    async def on_set_avatar_location(self, topic, message):
+        room_name = topic.split('/')[1]
+        if room_name in self.rooms and valid_location(message[1], message[2]):
+            self.rooms[room_name].pending[message[0]] = message
+
+    async def on_leave(self, topic, message):
+        room_name = topic.split('/')[1]
+        if room_name in self.rooms:
+            room = self.rooms[room_name]
+            room.pending.pop(message['user'], None)
+            room.announced.pop(message['user'], None)
+            if room.grid:
+                room.grid.remove(message['user'])
+                for visible in room.visible.values():
+                    visible.discard(message['user'])
+            for handler in list(self.rooms[room_name].handlers):
+                self.send(handler.room_remove_avatar(message))
+
+    def flush(self):
+        for room_name, room in self.rooms.items():
+            if room.grid:
+                self.flush_by_interest(room_name, room)
+            elif room.pending or room.announced:
+                batch = AvatarLocations(room_name, list(room.announced.values()), list(room.pending.values()))
+                room.announced = {}
+                room.pending = {}
+                for handler in list(room.handlers):
+                    self.send(handler.room_update_avatar_locations(batch))
+
+    def flush_by_interest(self, room_name: str, room: RoomMovement):
+        if not room.pending and not room.announced:
+            return
+        users = list(room.announced.values())
+        moved = room.pending
+        for user_id, x, y in moved.values():
+            room.grid.move(user_id, x, y)
+        room.announced = {}
+        room.pending = {}
+        for handler in list(room.handlers):
+            if handler.user is None or handler.user.id not in room.grid.positions:
+                self.send(handler.room_update_avatar_locations(AvatarLocations(room_name, users,
+                                                                               list(moved.values()))))
+                continue
+            visible = room.visible.get(handler, set())
+            in_range = room.grid.query(*room.grid.positions[handler.user.id], room.radius)
+            locations = [moved[user_id] for user_id in (in_range | visible) if user_id in moved]
+            locations.extend([[user_id, *room.grid.positions[user_id]] for user_id in in_range - visible
+                              if user_id not in moved])
+            room.visible[handler] = in_range
+            if users or locations:
+                self.send(handler.room_update_avatar_locations(AvatarLocations(room_name, users, locations)))
+
+    def send(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.sent)
+
+    def sent(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.warning(f'Failed to send movement update: {task.exception()}')
@@ -0,0 +1,237 @@
+import asyncio
+import asyncio_mqtt
+import logging
+
+from collections import deque
+from secrets import token_hex
+from typing import Awaitable, Callable, Hashable, Union
+
+from . import codec
+
+
+logger = logging.getLogger(__name__)
+
+MessageCallback = Callable[[str, Union[dict, bytes, None]], Awaitable[None]]
+
+
+class TopicNode():
+
+    __slots__ = ('children', 'callbacks')
+
+    def __init__(self):
+        self.children = {}
+        self.callbacks = []
+
+
+class TopicRouter():
+    """Trie of MQTT topic filters, supporting the ``+`` and ``#`` wildcards.
+
+    Each level of a filter is one node in the trie, so matching a topic costs one dict lookup per level and
+    wildcard, independent of the number of registered filters.
+    """
+
+    def __init__(self):
+        self.root = TopicNode()
+        self.filters = {}
+
+    def add(self, topic_filter: str, callback: Hashable) -> bool:
+        """Register the callback for the filter. Returns whether the filter is new."""
+        node = self.root
+        for level in topic_filter.split('/'):
+            if level not in node.children:
+                node.children[level] = TopicNode()
+            node = node.children[level]
+        node.callbacks.append(callback)
+        self.filters[topic_filter] = self.filters.get(topic_filter, 0) + 1
+        return self.filters[topic_filter] == 1
+
+    def remove(self, topic_filter: str, callback: Hashable) -> bool:
+        """Remove the callback from the filter. Returns whether the filter has no callbacks left."""
+        levels = topic_filter.split('/')
+        path = [self.root]
+        for level in levels:
+            if level not in path[-1].children:
+                return False
+            path.append(path[-1].children[level])
+        if callback not in path[-1].callbacks:
+            return False
+        path[-1].callbacks.remove(callback)
+        self.filters[topic_filter] = self.filters[topic_filter] - 1
+        if self.filters[topic_filter] == 0:
+            del self.filters[topic_filter]
+            for idx in range(len(levels) - 1, -1, -1):
+                if path[idx + 1].children or path[idx + 1].callbacks:
+                    break
+                del path[idx].children[levels[idx]]
+            return True
+        return False
+
+    def match(self, topic: str) -> list:
+        """Return the callbacks of all filters that match the topic, each callback at most once."""
+        callbacks = []
+        nodes = [self.root]
+        for idx, level in enumerate(topic.split('/')):
+            next_nodes = []
+            for node in nodes:
+                if '#' in node.children and not (idx == 0 and level.startswith('$')):
+                    callbacks.extend(node.children['#'].callbacks)
+                if level in node.children:
+                    next_nodes.append(node.children[level])
+                if '+' in node.children and not (idx == 0 and level.startswith('$')):
+                    next_nodes.append(node.children['+'])
+            nodes = next_nodes
+            if not nodes:
+                break
+        for node in nodes:
+            callbacks.extend(node.callbacks)
+            if '#' in node.children:
+                callbacks.extend(node.children['#'].callbacks)
+        return list(dict.fromkeys(callbacks))
+
+
+class MQTTClient():
+    """Single MQTT connection shared by all handlers of a server process.
+
+    Handlers register callbacks for topic filters. The broker subscription for a filter is only held while at
+    least one callback is registered for it and every incoming message is decoded at most once and then fanned out
+    to all matching callbacks in-process. Callbacks registered as ``raw`` receive the payload bytes undecoded.
+    Each callback has its own queue, so it receives its messages one at a time and in the order they arrived.
+
+    Each connection has a random ``node_id``. When the connection goes away, ``server/{node_id}/offline`` is
+    published (as the last will if the connection drops), so that shared state owned by the node can be cleaned
+    up. After a reconnect the client has a new ``node_id`` and calls the callbacks registered with
+    :meth:`on_reconnect`, which announce their shared state again under the new id. Messages for the previous
+    id then no longer affect that state, whether they arrive before or after the reconnect.
+    """
+
+    def __init__(self, hostname: str, port: int = 1883, reconnect_interval: int = 5):
+        self.node_id = token_hex(8)
+        self.hostname = hostname
+        self.port = port
+        self.reconnect_interval = reconnect_interval
+        self.router = TopicRouter()
+        self.client = None
+        self.connected = asyncio.Event()
+        self.running = True
+        self.queues = {}
+        self.tasks = set()
+        self.reconnect_callbacks = {}
+        self.connections = 0
+
+    async def run(self):
+        while self.running:
+            try:
+                if self.connections > 0:
+                    self.node_id = token_hex(8)
+                client = asyncio_mqtt.Client(hostname=self.hostname, port=self.port,
+                                             will=asyncio_mqtt.Will(f'server/{self.node_id}/offline'))
+                await client.connect(timeout=5)
+                try:
+                    async with client.unfiltered_messages() as messages:
+                        self.client = client
+                        for topic_filter in list(self.router.filters):
+                            await client.subscribe(topic_filter)
+                        self.connected.set()
+                        logger.debug(f'Connected to mqtt broker {self.hostname}:{self.port} as {self.node_id}')
+                        if self.connections > 0:
+                            for callback in list(self.reconnect_callbacks):
+                                self.spawn(self.announce(callback))
+                        self.connections = self.connections + 1
+                        async for message in messages:
+                            self.dispatch(message.topic, message.payload)
+                finally:
+                    self.connected.clear()
+                    self.client = None
+                    if self.running:
+                        try:
+                            await client.force_disconnect()
+                        except asyncio.InvalidStateError:
+                            pass
+            except asyncio_mqtt.MqttError as e:
+                if self.running:
+                    logger.warning(f'Lost connection to mqtt broker ({e}), reconnecting')
+                    await asyncio.sleep(self.reconnect_interval)
+            except Exception as e:
+                if self.running:
+                    logger.exception(f'Unexpected error in the mqtt client ({e}), reconnecting')
+                    await asyncio.sleep(self.reconnect_interval)
+
+    def dispatch(self, topic: str, payload: bytes):
+        callbacks = self.router.match(topic)
+        if not callbacks:
+            logger.debug(f'No subscribers for {topic}')
+            return
+        message = None
+        decoded = False
+        for callback, raw in callbacks:
+            if raw:
+                self.enqueue(callback, topic, payload)
+            else:
+                if not decoded:
+                    try:
+                        message = codec.loads(payload) if payload else None
+                        decoded = True
+                    except ValueError:
+                        logger.error(f'Invalid payload on {topic}')
+                        return
+                self.enqueue(callback, topic, message)
+
+    def enqueue(self, callback: MessageCallback, topic: str, message: Union[dict, bytes, None]):
+        """Queue the message for the callback, starting a delivery task if the callback has none running."""
+        if callback in self.queues:
+            self.queues[callback].append((topic, message))
+        else:
+            self.queues[callback] = deque([(topic, message)])
+            self.spawn(self.deliver(callback))
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def deliver(self, callback: MessageCallback):
+        queue = self.queues[callback]
+        try:
+            while queue:
+                topic, message = queue.popleft()
+                await self.call(callback, topic, message)
+        finally:
+            del self.queues[callback]
+
+    async def call(self, callback: MessageCallback, topic: str, message: Union[dict, bytes, None]):
+        try:
+            await callback(topic, message)
+        except Exception as e:
+            logger.error(f'Error handling {topic}: {e}')
+
+    async def announce(self, callback: Callable[[], Awaitable[None]]):
+        try:
+            await callback()
+        except Exception as e:
+            logger.error(f'Error announcing state after reconnecting: {e}')
+
+    def on_reconnect(self, callback: Callable[[], Awaitable[None]]):
+        """Register the callback to be called each time the client has reconnected under a new ``node_id``."""
+        self.reconnect_callbacks[callback] = True
+
+    def remove_on_reconnect(self, callback: Callable[[], Awaitable[None]]):
+        self.reconnect_callbacks.pop(callback, None)
+
+    async def subscribe(self, topic_filter: str, callback: MessageCallback, raw: bool = False):
+        """Register the callback for the filter. If ``raw`` is set, it receives the undecoded payload bytes."""
+        if self.router.add(topic_filter, (callback, raw)) and self.client:
+            await self.client.subscribe(topic_filter)
+
+    async def unsubscribe(self, topic_filter: str, callback: MessageCallback, raw: bool = False):
+        if self.router.remove(topic_filter, (callback, raw)) and self.client:
+            await self.client.unsubscribe(topic_filter)
+
+    async def publish(self, topic: str, payload=None, timeout: int = 5):
+        await asyncio.wait_for(self.connected.wait(), timeout)
+        await self.client.publish(topic, payload=payload)
+
+    async def disconnect(self):
+        self.running = False
+        if self.client:
+            await self.client.publish(f'server/{self.node_id}/offline')
+            await self.client.disconnect()
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+
+from collections import Counter, deque
+from time import monotonic
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketClosedError
+from typing import Hashable, Optional, Union
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+CONTROL = 'control'
+MOVEMENT = 'movement'
+COALESCE = 'coalesce'
+
+drop_counts = Counter()
+high_water_mark = 0
+
+metrics.register('outbound', lambda: {
+    'drops': dict(drop_counts),
+    'high_water_mark': high_water_mark
+})
+
+
+class OutboundQueue():
+    """Bounded queue of frames for one WebSocket, written out by a single writer task.
+
+    Frames are queued by class:
+
+    * ``CONTROL`` frames (chat, control and state messages) are never dropped.
+    * ``MOVEMENT`` frames carry their :class:`~senior_common_room.movement.AvatarLocations` batch as the key. While
+      the queue holds ``limit`` or more frames, a new batch is merged into a movement frame at the end of the queue,
+      keeping the latest location per user, so that no final location is lost.
+    * ``COALESCE`` frames replace any queued frame with the same key, so that only the latest update is sent.
+
+    If the queue stays at or above ``limit`` for longer than ``saturation_timeout`` seconds, the client cannot
+    keep up and ``on_saturated`` is called. This is also checked by a timer, in case the writer is stuck.
+
+    The number of dropped, merged and coalesced frames and the highest queue length are reported as the
+    ``outbound`` metrics.
+    """
+
+    def __init__(self, handler, limit: int, saturation_timeout: int, on_saturated):
+        self.handler = handler
+        self.limit = limit
+        self.saturation_timeout = saturation_timeout
+        self.on_saturated = on_saturated
+        self.frames = deque()
+        self.ready = asyncio.Event()
+        self.saturated_since = None
+        self.saturation_timer = None
+        self.high_water = 0
+        self.writer = None
+
+    def start(self):
+        self.writer = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.writer is not None:
+            self.writer.cancel()
+            self.writer = None
+        self.frames.clear()
+        self.clear_saturation()
+
+    def put(self, frame: Union[str, bytes], binary: bool = False, kind: str = CONTROL, key: Optional[Hashable] = None):
+        global high_water_mark
+        if self.writer is None:
+            return
+        if kind == COALESCE:
+            for idx, (queued_kind, queued_key, _, _) in enumerate(self.frames):
+                if queued_kind == COALESCE and queued_key == key:
+                    self.frames[idx] = (kind, key, frame, binary)
+                    drop_counts['coalesced'] += 1
+                    return
+        elif kind == MOVEMENT and len(self.frames) >= self.limit and key is not None:
+            queued_kind, queued_key, _, queued_binary = self.frames[-1]
+            if queued_kind == MOVEMENT and queued_binary == binary and queued_key is not None:
+                merged = queued_key.merge(key)
+                self.frames[-1] = (kind, merged, merged.binary_frame if binary else merged.json_frame, binary)
+                drop_counts['movement_merged'] += 1
+                self.check_saturation()
+                return
+        self.frames.append((kind, key, frame, binary))
+        if len(self.frames) > self.high_water:
+            self.high_water = len(self.frames)
+            high_water_mark = max(high_water_mark, self.high_water)
+        self.ready.set()
+        self.check_saturation()
+
+    def check_saturation(self):
+        if self.writer is not None and len(self.frames) >= self.limit:
+            if self.saturated_since is None:
+                self.saturated_since = monotonic()
+                self.saturation_timer = IOLoop.current().call_later(self.saturation_timeout, self.saturated)
+            elif monotonic() - self.saturated_since >= self.saturation_timeout:
+                self.saturated()
+        else:
+            self.clear_saturation()
+
+    def saturated(self):
+        logger.warning(f'Outbound queue saturated for more than {self.saturation_timeout}s, disconnecting')
+        drop_counts['disconnected'] += 1
+        self.clear_saturation()
+        self.on_saturated()
+
+    def clear_saturation(self):
+        self.saturated_since = None
+        if self.saturation_timer is not None:
+            IOLoop.current().remove_timeout(self.saturation_timer)
+            self.saturation_timer = None
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            while self.frames:
+                _, _, frame, binary = self.frames.popleft()
+                try:
+                    await self.handler.write_message(frame, binary=binary)
+                except WebSocketClosedError:
+                    self.frames.clear()
+                    return
+                self.check_saturation()
+            self.ready.clear()
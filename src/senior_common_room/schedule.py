@@ -0,0 +1,78 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from functools import lru_cache
+from pytz import timezone, utc, UnknownTimeZoneError
+from typing import Optional
+
+from . import codec
+
+
+def localise_schedule_entry(entry: dict, tz) -> dict:
+    start = entry['start'].astimezone(tz)
+    end = entry['end'].astimezone(tz)
+    return {
+        'title': entry['title'],
+        'start_date': start.strftime('%d %B %Y'),
+        'start_time': start.strftime('%H:%M %Z'),
+        'end_date': end.strftime('%d %B %Y'),
+        'end_time': end.strftime('%H:%M %Z'),
+        'day_diff': (end - start).days + 1 if start.year != end.year or start.month != end.month or start.day != end.day else 0,
+        'room': entry['room'],
+        'description': entry['description']
+    }
+
+
+class ScheduleStore():
+    """The schedule entries, indexed by start time.
+
+    The ``schedule-config`` frame lists the entries in their configured order, the queries return them sorted by
+    start time. Entries are localised at most once per timezone and the complete ``schedule-config`` frame is serialised at
+    most once per timezone. Both are kept for the ``cache_size`` most recently used timezones.
+    """
+
+    def __init__(self, entries: list, cache_size: int = 64):
+        order = sorted(range(len(entries)), key=lambda idx: entries[idx]['start'])
+        self.entries = [entries[idx] for idx in order]
+        self.configured_order = [0] * len(order)
+        for position, idx in enumerate(order):
+            self.configured_order[idx] = position
+        self.starts = [entry['start'] for entry in self.entries]
+        self.max_duration = max([entry['end'] - entry['start'] for entry in self.entries], default=timedelta(0))
+        self.localised = lru_cache(maxsize=cache_size)(self._localised)
+        self.frame = lru_cache(maxsize=cache_size)(self._frame)
+
+    @staticmethod
+    def timezone_name(name: Optional[str]) -> str:
+        try:
+            timezone(name)
+            return name
+        except (UnknownTimeZoneError, AttributeError):
+            return 'UTC'
+
+    def _localised(self, tz_name: str) -> list:
+        tz = timezone(tz_name)
+        return [localise_schedule_entry(entry, tz) for entry in self.entries]
+
+    def _frame(self, tz_name: str) -> bytes:
+        return codec.dumps({
+            'type': 'schedule-config',
+            'payload': [self.localised(tz_name)[position] for position in self.configured_order]
+        })
+
+    def now(self, tz_name: str, when: Optional[datetime] = None) -> list:
+        """Return the entries that are running at ``when`` (default now)."""
+        when = when or datetime.now(tz=utc)
+        return self.range(tz_name, when, when + timedelta(microseconds=1))
+
+    def next(self, tz_name: str, when: Optional[datetime] = None, count: int = 1) -> list:
+        """Return the next ``count`` entries that start after ``when`` (default now)."""
+        when = when or datetime.now(tz=utc)
+        idx = bisect_right(self.starts, when)
+        return self.localised(tz_name)[idx:idx + count]
+
+    def range(self, tz_name: str, start: datetime, end: datetime) -> list:
+        """Return the entries that overlap the period from ``start`` to ``end``."""
+        localised = self.localised(tz_name)
+        return [localised[idx]
+                for idx in range(bisect_left(self.starts, start - self.max_duration), bisect_left(self.starts, end))
+                if self.entries[idx]['end'] > start]
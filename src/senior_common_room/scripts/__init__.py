@@ -10,6 +10,8 @@ from typing import Union
 
 from .server import server
 from .database import database
+from .avatars import avatars
+from .maps import maps
 
 
 def parse_datetime(value: str):
@@ -20,6 +22,11 @@ def parse_datetime(value: str):
     }).astimezone(utc)
 
 
+def check_email_sink(field, value, error):
+    if value.get('sink') == 'file' and not value.get('directory'):
+        error(field, "directory is required if the sink is 'file'")
+
+
 CONFIG_SCHEMA = {
     'core': {
         'type': 'dict',
@@ -44,6 +51,24 @@ CONFIG_SCHEMA = {
                 'type': 'string',
                 'required': True,
                 'empty': False
+            },
+            'pool_size': {
+                'type': 'integer',
+                'min': 1,
+                'default': 5
+            },
+            'max_overflow': {
+                'type': 'integer',
+                'min': 0,
+                'default': 10
+            },
+            'pool_pre_ping': {
+                'type': 'boolean',
+                'default': True
+            },
+            'pool_recycle': {
+                'type': 'integer',
+                'default': 3600
             }
         }
     },
@@ -69,8 +94,92 @@ CONFIG_SCHEMA = {
                     'avatars': {
                         'type': 'string',
                         'required': True
+                    },
+                    'variants': {
+                        'type': 'string',
+                        'empty': False,
+                        'default': '/api/avatars'
+                    },
+                    'atlases': {
+                        'type': 'string',
+                        'empty': False,
+                        'default': '/api/atlases'
                     }
                 }
+            },
+            'main': {
+                'type': 'boolean',
+                'default': True
+            },
+            'movement_tick': {
+                'type': 'integer',
+                'min': 10,
+                'default': 50
+            },
+            'address': {
+                'type': 'string',
+                'empty': False,
+                'default': '0.0.0.0'
+            },
+            'port': {
+                'type': 'integer',
+                'min': 1,
+                'max': 65535,
+                'default': 6543
+            },
+            'workers': {
+                'type': 'integer',
+                'min': 0,
+                'default': 1
+            },
+            'debug': {
+                'type': 'boolean',
+                'default': False
+            },
+            'outbound_queue': {
+                'type': 'integer',
+                'min': 1,
+                'default': 256
+            },
+            'saturation_timeout': {
+                'type': 'integer',
+                'min': 1,
+                'default': 30
+            },
+            'ping_interval': {
+                'type': 'integer',
+                'min': 1,
+                'default': 30
+            },
+            'user_cache_size': {
+                'type': 'integer',
+                'min': 0,
+                'default': 1000
+            },
+            'user_cache_ttl': {
+                'type': 'integer',
+                'min': 0,
+                'default': 300
+            },
+            'session_grace': {
+                'type': 'integer',
+                'min': 0,
+                'default': 30
+            },
+            'session_replay': {
+                'type': 'integer',
+                'min': 0,
+                'default': 50
+            },
+            'atlas_interval': {
+                'type': 'integer',
+                'min': 0,
+                'default': 1000
+            },
+            'metrics_interval': {
+                'type': 'integer',
+                'min': 0,
+                'default': 60
             }
         }
     },
@@ -95,6 +204,19 @@ CONFIG_SCHEMA = {
                     'required': True,
                     'empty': False
                 },
+                'mapFile': {
+                    'type': 'string',
+                    'required': False,
+                    'nullable': True,
+                    'default': None
+                },
+                'interest_radius': {
+                    'type': 'integer',
+                    'min': 1,
+                    'required': False,
+                    'nullable': True,
+                    'default': None
+                },
                 'tilesets': {
                     'type': 'list',
                     'schema': {
@@ -149,6 +271,7 @@ CONFIG_SCHEMA = {
     'email': {
         'type': 'dict',
         'required': True,
+        'check_with': check_email_sink,
         'schema': {
             'server': {
                 'type': 'string',
@@ -178,6 +301,37 @@ CONFIG_SCHEMA = {
                         'empty': False
                     }
                 }
+            },
+            'sink': {
+                'type': 'string',
+                'allowed': ['smtp', 'file', 'log'],
+                'default': 'smtp'
+            },
+            'directory': {
+                'type': 'string',
+                'empty': False,
+                'required': False,
+                'dependencies': {'sink': 'file'}
+            },
+            'queue_size': {
+                'type': 'integer',
+                'min': 1,
+                'default': 1000
+            },
+            'workers': {
+                'type': 'integer',
+                'min': 1,
+                'default': 2
+            },
+            'retries': {
+                'type': 'integer',
+                'min': 0,
+                'default': 3
+            },
+            'retry_delay': {
+                'type': 'integer',
+                'min': 1,
+                'default': 5
             }
         }
     },
@@ -212,6 +366,22 @@ CONFIG_SCHEMA = {
             'main': {
                 'type': 'boolean',
                 'default': True
+            },
+            'user_list_interval': {
+                'type': 'integer',
+                'min': 0,
+                'default': 250
+            },
+            'lease': {
+                'type': 'integer',
+                'min': 10,
+                'default': 120
+            },
+            'snapshot': {
+                'type': 'string',
+                'empty': False,
+                'nullable': True,
+                'default': None
             }
         }
     },
@@ -222,9 +392,67 @@ CONFIG_SCHEMA = {
             'avatars': {
                 'type': 'string',
                 'required': True
+            },
+            'maps': {
+                'type': 'string',
+                'required': False,
+                'nullable': True,
+                'default': None
             }
         }
     },
+    'images': {
+        'type': 'dict',
+        'schema': {
+            'workers': {
+                'type': 'integer',
+                'min': 1,
+                'default': 2
+            },
+            'concurrency': {
+                'type': 'integer',
+                'min': 1,
+                'default': 2
+            },
+            'queue_size': {
+                'type': 'integer',
+                'min': 0,
+                'default': 50
+            },
+            'max_upload': {
+                'type': 'integer',
+                'min': 1,
+                'default': 10485760
+            },
+            'max_resolution': {
+                'type': 'integer',
+                'min': 48,
+                'default': 512
+            },
+            'variant_sizes': {
+                'type': 'list',
+                'schema': {
+                    'type': 'integer',
+                    'min': 1
+                },
+                'default': [48, 96, 256]
+            },
+            'variant_cache_size': {
+                'type': 'integer',
+                'min': 0,
+                'default': 104857600
+            }
+        },
+        'default': {
+            'workers': 2,
+            'concurrency': 2,
+            'queue_size': 50,
+            'max_upload': 10485760,
+            'max_resolution': 512,
+            'variant_sizes': [48, 96, 256],
+            'variant_cache_size': 104857600
+        }
+    },
     'schedule': {
         'type': 'list',
         'default': [],
@@ -333,3 +561,5 @@ def main(ctx):
 
 main.add_command(server)
 main.add_command(database)
+main.add_command(avatars)
+main.add_command(maps)
@@ -0,0 +1,110 @@
+import asyncio
+import click
+import logging
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from PIL import Image
+from sqlalchemy import update
+from sqlalchemy.future import select
+from typing import List, Optional
+
+from ..avatars import AvatarStore, VARIANT_FORMATS, avatar_name, write_file
+from ..images import process_avatar_variant
+from ..models import create_sessionmaker, dispose_engines, setup_engine, User
+from .database import publish_reconnects
+
+
+logger = logging.getLogger(__name__)
+
+
+@click.group()
+def avatars():
+    pass
+
+
+def cap_avatar(directory: str, name: str, max_resolution: int) -> Optional[str]:
+    """Scale the large image of the avatar down to ``max_resolution``. Returns the new name of the avatar, if the
+    image had to be scaled."""
+    with open(os.path.join(directory, f'{name}-large.png'), 'rb') as in_f:
+        img = Image.open(BytesIO(in_f.read()), formats=['PNG'])
+    if img.size[0] <= max_resolution and img.size[1] <= max_resolution:
+        return None
+    img.thumbnail((max_resolution, max_resolution), Image.Resampling.LANCZOS)
+    out = BytesIO()
+    img.save(out, format='PNG')
+    large = out.getvalue()
+    with open(os.path.join(directory, f'{name}-small.png'), 'rb') as in_f:
+        small = in_f.read()
+    name = avatar_name(large, small)
+    write_file(os.path.join(directory, f'{name}-large.png'), large)
+    write_file(os.path.join(directory, f'{name}-small.png'), small)
+    return name
+
+
+def generate_variants(directory: str, name: str, sizes: List[int]) -> int:
+    """Generate all missing variants of the avatar. Returns the number of variants generated."""
+    with open(os.path.join(directory, f'{name}-large.png'), 'rb') as in_f:
+        data = in_f.read()
+    count = 0
+    for size in sizes:
+        for format in VARIANT_FORMATS:
+            path = os.path.join(directory, 'variants', f'{name}-{size}.{format}')
+            if not os.path.exists(path):
+                write_file(path, process_avatar_variant(data, size, format))
+                count = count + 1
+    return count
+
+
+async def async_rename_avatars(config, renamed: dict):
+    """Point all users of the avatars in ``renamed`` at the new names and tell them to reconnect."""
+    sessionmaker = create_sessionmaker(setup_engine(config))
+    user_ids = []
+    try:
+        async with sessionmaker() as session:
+            async with session.begin():
+                for previous, name in renamed.items():
+                    result = await session.execute(select(User.id).filter(User.avatar == previous))
+                    user_ids.extend(result.scalars())
+                    await session.execute(update(User).where(User.avatar == previous).values(avatar=name))
+    finally:
+        await dispose_engines()
+    await publish_reconnects(config, user_ids)
+    return user_ids
+
+
+@click.command()
+@click.pass_context
+@click.option('--workers', type=int, help='Number of worker processes, by default images.workers')
+@click.option('--variants/--no-variants', default=True, help='Generate the avatar variants')
+def backfill(ctx, workers, variants):
+    """Scale existing avatars down to images.max_resolution and generate their variants."""
+    config = ctx.obj['config']
+    store = AvatarStore(config['storage']['avatars'])
+    names = sorted(store.index)
+    with ProcessPoolExecutor(max_workers=workers or config['images']['workers'],
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        capped = executor.map(cap_avatar,
+                              [store.directory] * len(names),
+                              names,
+                              [config['images']['max_resolution']] * len(names))
+        renamed = dict([(previous, name) for previous, name in zip(names, capped)
+                        if name is not None and name != previous])
+        if renamed:
+            user_ids = asyncio.run(async_rename_avatars(config, renamed))
+            for previous in renamed:
+                store.remove(previous)
+            names = sorted(set(names) - set(renamed) | set(renamed.values()))
+            click.echo(f'Scaled down {len(renamed)} avatars used by {len(user_ids)} users')
+        if variants:
+            os.makedirs(os.path.join(store.directory, 'variants'), exist_ok=True)
+            count = sum(executor.map(generate_variants,
+                                     [store.directory] * len(names),
+                                     names,
+                                     [config['images']['variant_sizes']] * len(names)))
+            click.echo(f'Generated {count} variants for {len(names)} avatars')
+
+
+avatars.add_command(backfill)
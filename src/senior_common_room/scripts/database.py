@@ -1,11 +1,14 @@
 import asyncio
 import asyncio_mqtt
 import click
+import csv
+import json
 import logging
 
+from sqlalchemy import func
 from sqlalchemy.future import select
 
-from ..models import create_engine, create_sessionmaker, Base, User
+from ..models import create_engine, create_sessionmaker, dispose_engines, migrations, setup_engine, Base, User
 
 
 logger = logging.getLogger(__name__)
@@ -17,11 +20,13 @@ def database():
 
 
 async def create_database(config):
-    async with create_engine(config['database']['dsn']).begin() as conn:
+    engine = create_engine(config['database']['dsn'])
+    async with engine.begin() as conn:
         logger.debug('Dropping existing database tables')
         await conn.run_sync(Base.metadata.drop_all)
         logger.debug('Creating database tables')
         await conn.run_sync(Base.metadata.create_all)
+    await migrations.stamp(engine)
     logger.debug('Database created')
 
 
@@ -31,6 +36,40 @@ def create(ctx):
     asyncio.run(create_database(ctx.obj['config']))
 
 
+async def async_upgrade(config, version):
+    try:
+        version = await migrations.upgrade(setup_engine(config), version)
+    finally:
+        await dispose_engines()
+    click.echo(f'Database schema at version {version}')
+
+
+@click.command()
+@click.pass_context
+@click.option('--version', type=click.IntRange(0, migrations.LATEST_VERSION), default=migrations.LATEST_VERSION,
+              help='Schema version to upgrade to, by default the latest')
+def upgrade(ctx, version):
+    """Upgrade the database schema."""
+    asyncio.run(async_upgrade(ctx.obj['config'], version))
+
+
+async def async_downgrade(config, version):
+    try:
+        version = await migrations.downgrade(setup_engine(config), version)
+    finally:
+        await dispose_engines()
+    click.echo(f'Database schema at version {version}')
+
+
+@click.command()
+@click.pass_context
+@click.option('--version', type=click.IntRange(0, migrations.LATEST_VERSION),
+              help='Schema version to downgrade to, by default the previous one')
+def downgrade(ctx, version):
+    """Downgrade the database schema."""
+    asyncio.run(async_downgrade(ctx.obj['config'], version))
+
+
 async def create_user(config, email, name):
     async with create_sessionmaker(config['database']['dsn'])() as session:
         async with session.begin():
@@ -45,15 +84,32 @@ def add_user(ctx, email, name):
     asyncio.run(create_user(ctx.obj['config'], email, name))
 
 
+async def publish_user_events(config, user_ids, event):
+    """Publish ``user/{id}/{event}`` for all given users, over a single MQTT connection."""
+    if user_ids:
+        async with asyncio_mqtt.Client(hostname=config['mosquitto'], port=1883) as mqtt:
+            for user_id in user_ids:
+                await mqtt.publish(f'user/{user_id}/{event}')
+
+
+async def publish_reconnects(config, user_ids):
+    """Tell all handlers of the given users to disconnect them."""
+    await publish_user_events(config, user_ids, 'reconnect')
+
+
 async def async_add_role_to_user(config, email, role):
+    user_id = None
     async with create_sessionmaker(config['database']['dsn'])() as session:
         async with session.begin():
-            query = select(User).filter(User.email == email)
+            query = select(User).filter(func.lower(User.email) == email.lower())
             result = await session.execute(query)
             user = result.scalars().first()
             if user:
                 if role not in user.roles:
                     user.roles.append(role)
+                    user_id = user.id
+    if user_id is not None:
+        await publish_user_events(config, [user_id], 'updated')
 
 
 @click.command()
@@ -65,14 +121,18 @@ def add_role_to_user(ctx, email, role):
 
 
 async def async_remove_role_from_user(config, email, role):
+    user_id = None
     async with create_sessionmaker(config['database']['dsn'])() as session:
         async with session.begin():
-            query = select(User).filter(User.email == email)
+            query = select(User).filter(func.lower(User.email) == email.lower())
             result = await session.execute(query)
             user = result.scalars().first()
             if user:
                 if role in user.roles:
                     user.roles.remove(role)
+                    user_id = user.id
+    if user_id is not None:
+        await publish_user_events(config, [user_id], 'updated')
 
 
 @click.command()
@@ -84,16 +144,17 @@ def remove_role_from_user(ctx, email, role):
 
 
 async def async_block_unblock_user(config, email, status):
+    user_id = None
     async with create_sessionmaker(config['database']['dsn'])() as session:
         async with session.begin():
-            query = select(User).filter(User.email == email)
+            query = select(User).filter(func.lower(User.email) == email.lower())
             result = await session.execute(query)
             user = result.scalars().first()
             if user:
                 user.status = status
-                mqtt = asyncio_mqtt.Client(hostname=config['mosquitto'], port=1883)
-                await mqtt.connect(timeout=5)
-                await mqtt.publish(f'user/{user.id}/reconnect')
+                user_id = user.id
+    if user_id is not None:
+        await publish_reconnects(config, [user_id])
 
 
 @click.command()
@@ -112,9 +173,204 @@ def unblock_user(ctx, email):
     asyncio.run(async_block_unblock_user(ctx.obj['config'], email, 'active'))
 
 
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def file_format(path, format):
+    if format:
+        return format
+    elif path.endswith('.jsonl'):
+        return 'jsonl'
+    return 'csv'
+
+
+def read_users(in_f, format):
+    """Yield one dict with the email, name and optional roles for each user in the CSV or JSONL input."""
+    if format == 'jsonl':
+        for line in in_f:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        for row in csv.DictReader(in_f):
+            if row.get('roles'):
+                row['roles'] = [role.strip() for role in row['roles'].split(';') if role.strip()]
+            else:
+                row.pop('roles', None)
+            yield row
+
+
+def read_emails(in_f):
+    """Yield the lower-cased e-mail addresses in the input, one per line. Blank lines and # comments are ignored."""
+    for line in in_f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line.lower()
+
+
+def upsert_users(dialect, rows, replace_roles):
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise click.ClickException(f'Bulk import is not supported for {dialect} databases')
+    stmt = insert(User).values(rows)
+    update = {'name': stmt.excluded.name}
+    if replace_roles:
+        update['roles'] = stmt.excluded.roles
+    return stmt.on_conflict_do_update(index_elements=[User.email], set_=update)
+
+
+async def async_import_users(config, in_f, format, batch_size, replace_roles):
+    engine = setup_engine(config)
+    count = 0
+    updated_ids = []
+    try:
+        async with engine.begin() as conn:
+            for batch in batched(read_users(in_f, format), batch_size):
+                rows = dict([(user['email'].lower(), {
+                    'email': user['email'].lower(),
+                    'name': user['name'],
+                    'roles': user.get('roles', []),
+                    'status': 'active'
+                }) for user in batch])
+                result = await conn.execute(select(User.id).filter(User.email.in_(list(rows))))
+                updated_ids.extend(result.scalars())
+                await conn.execute(upsert_users(engine.dialect.name, list(rows.values()), replace_roles))
+                count = count + len(rows)
+                logger.debug(f'Imported {count} users')
+    finally:
+        await dispose_engines()
+    await publish_user_events(config, updated_ids, 'updated')
+    click.echo(f'Imported {count} users')
+
+
+@click.command()
+@click.pass_context
+@click.argument('source', type=click.File('r'))
+@click.option('--format', type=click.Choice(['csv', 'jsonl']), help='Input format, by default from the file extension')
+@click.option('--batch-size', type=int, default=500, help='Number of users to insert per statement')
+@click.option('--replace-roles', is_flag=True, help='Replace the roles of existing users')
+def import_users(ctx, source, format, batch_size, replace_roles):
+    """Create or update the users in SOURCE.
+
+    SOURCE is a CSV file with email, name and optional roles (separated by ;) columns or a JSONL file with one
+    {"email", "name", "roles"} object per line. Existing users, matched by e-mail, have their name updated.
+    """
+    asyncio.run(async_import_users(ctx.obj['config'], source, file_format(source.name, format), batch_size,
+                                   replace_roles))
+
+
+async def async_export_users(config, out_f, format, batch_size):
+    engine = setup_engine(config)
+    fields = ['id', 'email', 'name', 'roles', 'status']
+    count = 0
+    try:
+        if format == 'csv':
+            writer = csv.DictWriter(out_f, fieldnames=fields)
+            writer.writeheader()
+        async with engine.connect() as conn:
+            result = await conn.stream(select(User.id, User.email, User.name, User.roles, User.status)
+                                       .order_by(User.id))
+            async for batch in result.partitions(batch_size):
+                for row in batch:
+                    user = dict(row._mapping)
+                    if format == 'csv':
+                        user['roles'] = ';'.join(user['roles'] or [])
+                        writer.writerow(user)
+                    else:
+                        out_f.write(json.dumps(user))
+                        out_f.write('\n')
+                count = count + len(batch)
+    finally:
+        await dispose_engines()
+    click.echo(f'Exported {count} users', err=True)
+
+
+@click.command()
+@click.pass_context
+@click.argument('target', type=click.File('w'))
+@click.option('--format', type=click.Choice(['csv', 'jsonl']), help='Output format, by default from the file extension')
+@click.option('--batch-size', type=int, default=500, help='Number of users to fetch at a time')
+def export_users(ctx, target, format, batch_size):
+    """Export all users to TARGET as CSV or JSONL."""
+    asyncio.run(async_export_users(ctx.obj['config'], target, file_format(target.name, format), batch_size))
+
+
+async def async_bulk_update_users(config, in_f, batch_size, update):
+    """Apply ``update`` to all users whose e-mail is listed in the input, in a single transaction, and then tell
+    the affected users to reconnect."""
+    sessionmaker = create_sessionmaker(setup_engine(config))
+    user_ids = []
+    try:
+        async with sessionmaker() as session:
+            async with session.begin():
+                for batch in batched(read_emails(in_f), batch_size):
+                    result = await session.execute(select(User).filter(func.lower(User.email).in_(batch)))
+                    for user in result.scalars():
+                        if update(user):
+                            user_ids.append(user.id)
+    finally:
+        await dispose_engines()
+    await publish_reconnects(config, user_ids)
+    click.echo(f'Updated {len(user_ids)} users')
+
+
+@click.command()
+@click.pass_context
+@click.argument('source', type=click.File('r'))
+@click.option('--role', required=True, prompt='Role')
+@click.option('--remove', is_flag=True, help='Remove the role instead of adding it')
+@click.option('--batch-size', type=int, default=500, help='Number of users to update per query')
+def assign_roles(ctx, source, role, remove, batch_size):
+    """Add the role to (or remove it from) all users whose e-mail is listed in SOURCE, one per line."""
+    def update(user):
+        if remove and user.roles and role in user.roles:
+            user.roles.remove(role)
+            return True
+        elif not remove and (not user.roles or role not in user.roles):
+            user.roles = (user.roles or []) + [role]
+            return True
+        return False
+
+    asyncio.run(async_bulk_update_users(ctx.obj['config'], source, batch_size, update))
+
+
+@click.command()
+@click.pass_context
+@click.argument('source', type=click.File('r'))
+@click.option('--unblock', is_flag=True, help='Unblock the users instead of blocking them')
+@click.option('--batch-size', type=int, default=500, help='Number of users to update per query')
+def block_users(ctx, source, unblock, batch_size):
+    """Block (or unblock) all users whose e-mail is listed in SOURCE, one per line."""
+    status = 'active' if unblock else 'blocked'
+
+    def update(user):
+        if user.status != status:
+            user.status = status
+            return True
+        return False
+
+    asyncio.run(async_bulk_update_users(ctx.obj['config'], source, batch_size, update))
+
+
 database.add_command(create)
+database.add_command(upgrade)
+database.add_command(downgrade)
 database.add_command(add_user)
 database.add_command(add_role_to_user)
 database.add_command(remove_role_from_user)
 database.add_command(block_user)
 database.add_command(unblock_user)
+database.add_command(import_users)
+database.add_command(export_users)
+database.add_command(assign_roles)
+database.add_command(block_users)
@@ -0,0 +1,34 @@
+import click
+import os
+
+from .. import codec
+from ..avatars import write_file
+from ..maps import CompiledMap, compile_maps
+
+
+@click.group()
+def maps():
+    pass
+
+
+@click.command()
+@click.pass_context
+def compile(ctx):
+    """Compile the maps of all rooms with a mapFile into storage.maps."""
+    config = ctx.obj['config']
+    directory = config['storage']['maps']
+    if not directory:
+        raise click.ClickException('No storage.maps directory configured')
+    try:
+        compiled = compile_maps(config['rooms'])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise click.ClickException(f'Failed to compile the room maps: {e}')
+    os.makedirs(directory, exist_ok=True)
+    for slug, data in compiled.items():
+        compiled_map = CompiledMap(data)
+        write_file(os.path.join(directory, f'{slug}.json'), codec.dumps(data))
+        click.echo(f'Compiled {slug} ({compiled_map.width}x{compiled_map.height}, {len(compiled_map.frame)} bytes, '
+                   f'version {compiled_map.version})')
+
+
+maps.add_command(compile)
@@ -4,6 +4,14 @@ from ..server import start_server
 
 
 @click.command()
+@click.option('--workers', type=int, help='Number of worker processes, 0 for one per CPU')
+@click.option('--port', type=int, help='Port to listen on')
+@click.option('--address', help='Address to bind to')
+@click.option('--debug/--no-debug', default=None, help='Run in debug mode')
 @click.pass_context
-def server(ctx):
-    start_server(ctx.obj['config'])
+def server(ctx, workers, port, address, debug):
+    config = ctx.obj['config']
+    for key, value in (('workers', workers), ('port', port), ('address', address), ('debug', debug)):
+        if value is not None:
+            config['server'][key] = value
+    start_server(config)
@@ -1,115 +1,463 @@
-import asyncio
-import asyncio_mqtt
-import json
 import logging
+import os
+import re
 
+from collections import Counter, defaultdict
 from secrets import token_hex
+from time import time
+from urllib.parse import urlparse
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
 from tornado.web import Application
-from tornado.ioloop import IOLoop
 
-from ..handlers import ApiHandler
+from .. import codec, metrics
+from ..api.config import ConfigFrames
+from ..atlas import RoomAtlas
+from ..avatars import AvatarStore, VariantCache
+from ..cache import UserCache
+from ..handlers import ApiHandler, AtlasHandler, AvatarUploadHandler, AvatarVariantHandler, MapHandler
+from ..images import ImageProcessor
+from ..mail import MailQueue
+from ..maps import MapIndex
+from ..models import create_sessionmaker, dispose_engines, setup_engine
+from ..movement import MovementAggregator
+from ..schedule import ScheduleStore
+from ..sessions import SessionStore
+from ..mqtt import MQTTClient
 
 
 logger = logging.getLogger(__name__)
 
+jitsi_room_counts = defaultdict(Counter)
 
-async def jitsi_room_state_server(config):
+metrics.register('jitsi_rooms', lambda: dict([(room, dict(counts)) for room, counts in jitsi_room_counts.items()]))
+
+
+def load_jitsi_rooms(path: str, lease: int) -> dict:
+    """Load the jitsi rooms from a snapshot, giving every member a fresh lease to re-confirm their membership."""
     jitsi_rooms = {}
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'rb') as in_f:
+                snapshot = codec.loads(in_f.read())
+            expires = time() + lease
+            for room_name, room in snapshot.items():
+                jitsi_rooms[room_name] = {
+                    'url': room['url'],
+                    'password': room['password'],
+                    'users': dict([(int(user_id), expires) for user_id in room['users']]),
+                    'nodes': dict([(int(user_id), node) for user_id, node in room['nodes'].items()]),
+                    'subject': room['subject'],
+                    'counter': room['counter'],
+                    'user_list': None
+                }
+            logger.info(f'Restored {len(jitsi_rooms)} jitsi rooms from {path}')
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f'Failed to restore jitsi rooms from {path}: {e}')
+    return jitsi_rooms
+
+
+def save_jitsi_rooms(path: str, snapshot: bytes):
+    with open(f'{path}.tmp', 'wb') as out_f:
+        out_f.write(snapshot)
+    os.replace(f'{path}.tmp', path)
+
+
+async def jitsi_room_state_server(config, mqtt):
+    """Track the members of all jitsi rooms.
+
+    User-list updates are debounced per room, so a room publishes at most one user-list per
+    ``jitsi.user_list_interval`` milliseconds, however many users enter or leave in that time.
+
+    Membership is a lease of ``jitsi.lease`` seconds, renewed by the heartbeats of the user's handler. Members whose
+    lease has expired or whose server node has gone offline are removed. An enter message with ``rejoin`` set only
+    moves an existing member to its handler's new node. If ``jitsi.snapshot`` is set, the room table is saved to
+    that file after each change and restored from it on startup. Changes made while the file is being written are
+    saved together once the write has finished.
+    """
+    lease = config['jitsi']['lease']
+    snapshot_path = config['jitsi']['snapshot']
+    jitsi_rooms = load_jitsi_rooms(snapshot_path, lease)
+    interval = config['jitsi']['user_list_interval'] / 1000
+    dirty = False
+    saving = False
     logger.debug('Jitsi room state server starting up')
-    async with asyncio_mqtt.Client(config['mosquitto']) as client:
-        logger.debug('Jitsi room state server started')
-
-        async def enter_handler():
-            async with client.filtered_messages("jitsi-rooms/+/enter") as messages:
-                await client.subscribe("jitsi-rooms/+/enter")
-                async for message in messages:
-                    payload = json.loads(message.payload.decode())
-                    room_name = message.topic.split('/')[1]
-                    if room_name == '_private':
-                        room_name = token_hex(32)
-                        while room_name in jitsi_rooms:
-                            room_name = token_hex(32)
-                        jitsi_rooms[room_name] = {
-                            'url': token_hex(32),
-                            'password': token_hex(32),
-                            'users': payload['users'],
-                            'subject': 'Private chat'
-                        }
-                        for user in payload['users']:
-                            await client.publish(f'user/{user}/enter-jitsi-room',
-                                                 payload=json.dumps({
-                                                     'room_name': room_name,
-                                                     'url': jitsi_rooms[room_name]['url'],
-                                                     'password': jitsi_rooms[room_name]['password'],
-                                                     'subject': jitsi_rooms[room_name]['subject']
-                                                 }).encode())
-                        await client.publish(f'jitsi-rooms/{room_name}/request-user-list')
-                    else:
-                        if room_name not in jitsi_rooms:
-                            jitsi_rooms[room_name] = {
-                                'url': token_hex(32),
-                                'password': token_hex(32),
-                                'users': [payload['user']],
-                                'subject': payload['subject']
-                            }
-                        elif payload['user'] not in jitsi_rooms[room_name]['users']:
-                            jitsi_rooms[room_name]['users'].append(payload['user'])
-                        logger.debug(f'Entering jitsi room for user/{payload["user"]}/enter-jitsi-room')
-                        await client.publish(f'user/{payload["user"]}/enter-jitsi-room',
-                                             payload=json.dumps({
-                                                 'room_name': room_name,
-                                                 'url': jitsi_rooms[room_name]['url'],
-                                                 'password': jitsi_rooms[room_name]['password'],
-                                                 'subject': jitsi_rooms[room_name]['subject']
-                                             }).encode())
-                        await client.publish(f'jitsi-rooms/{room_name}/request-user-list')
-
-        async def leave_handler():
-            async with client.filtered_messages("jitsi-rooms/+/leave") as messages:
-                await client.subscribe("jitsi-rooms/+/leave")
-                async for message in messages:
-                    payload = json.loads(message.payload.decode())
-                    room_name = message.topic.split('/')[1]
-                    if room_name in jitsi_rooms:
-                        if payload['user'] in jitsi_rooms[room_name]['users']:
-                            jitsi_rooms[room_name]['users'].remove(payload['user'])
-                            logger.debug(f'User {payload["user"]} leaving {room_name}')
-                            await client.publish(f'user/{payload["user"]}/leave_jitsi_room')
-                            await client.publish(f'jitsi-rooms/{room_name}/request-user-list')
-                        if len(jitsi_rooms[room_name]['users']) == 0:
-                            del jitsi_rooms[room_name]
-
-        async def request_user_list_handler():
-            async with client.filtered_messages("jitsi-rooms/+/request-user-list") as messages:
-                await client.subscribe("jitsi-rooms/+/request-user-list")
-                async for message in messages:
-                    room_name = message.topic.split('/')[1]
-                    if room_name in jitsi_rooms:
-                        await client.publish(f'jitsi-rooms/{room_name}/user-list',
-                                             payload=json.dumps({'users': jitsi_rooms[room_name]['users']}).encode())
-
-        await asyncio.gather(enter_handler(), leave_handler(), request_user_list_handler())
+
+    def changed():
+        nonlocal dirty, saving
+        dirty = True
+        if snapshot_path and not saving:
+            saving = True
+            IOLoop.current().add_callback(save_snapshot)
+
+    async def save_snapshot():
+        nonlocal dirty, saving
+        try:
+            while dirty:
+                dirty = False
+                snapshot = codec.dumps(dict([(room_name, {
+                    'url': room['url'],
+                    'password': room['password'],
+                    'users': list(room['users']),
+                    'nodes': dict([(str(user_id), node) for user_id, node in room['nodes'].items()]),
+                    'subject': room['subject'],
+                    'counter': room['counter']
+                }) for room_name, room in jitsi_rooms.items()]))
+                try:
+                    await IOLoop.current().run_in_executor(None, save_jitsi_rooms, snapshot_path, snapshot)
+                except OSError as e:
+                    logger.error(f'Failed to save the jitsi rooms to {snapshot_path}: {e}')
+        finally:
+            saving = False
+
+    def schedule_user_list(room_name):
+        if room_name in jitsi_rooms and jitsi_rooms[room_name]['user_list'] is None:
+            jitsi_rooms[room_name]['user_list'] = IOLoop.current().call_later(interval, publish_user_list, room_name)
+
+    async def publish_user_list(room_name):
+        if room_name in jitsi_rooms:
+            jitsi_rooms[room_name]['user_list'] = None
+            jitsi_room_counts[jitsi_rooms[room_name]['counter']]['user-list'] += 1
+            await mqtt.publish(f'jitsi-rooms/{room_name}/user-list',
+                               payload=codec.dumps({'users': sorted(jitsi_rooms[room_name]['users'])}))
+
+    async def enter_user(user_id, room_name):
+        await mqtt.publish(f'user/{user_id}/enter-jitsi-room',
+                           payload=codec.dumps({
+                               'room_name': room_name,
+                               'url': jitsi_rooms[room_name]['url'],
+                               'password': jitsi_rooms[room_name]['password'],
+                               'subject': jitsi_rooms[room_name]['subject']
+                           }))
+
+    async def remove_user(room_name, user_id, counter):
+        room = jitsi_rooms[room_name]
+        if user_id in room['users']:
+            del room['users'][user_id]
+            room['nodes'].pop(user_id, None)
+            jitsi_room_counts[room['counter']][counter] += 1
+            changed()
+            logger.debug(f'User {user_id} leaving {room_name}')
+            await mqtt.publish(f'user/{user_id}/leave_jitsi_room')
+            schedule_user_list(room_name)
+        if len(room['users']) == 0:
+            if room['user_list'] is not None:
+                IOLoop.current().remove_timeout(room['user_list'])
+            del jitsi_rooms[room_name]
+            changed()
+
+    async def enter_handler(topic, message):
+        room_name = topic.split('/')[1]
+        expires = time() + lease
+        if room_name == '_private':
+            room_name = token_hex(32)
+            while room_name in jitsi_rooms:
+                room_name = token_hex(32)
+            jitsi_rooms[room_name] = {
+                'url': token_hex(32),
+                'password': token_hex(32),
+                'users': dict([(user_id, expires) for user_id in message['users']]),
+                'nodes': {},
+                'subject': 'Private chat',
+                'counter': '_private',
+                'user_list': None
+            }
+            jitsi_room_counts['_private']['enter'] += len(message['users'])
+            for user_id in message['users']:
+                await enter_user(user_id, room_name)
+        else:
+            if room_name not in jitsi_rooms:
+                jitsi_rooms[room_name] = {
+                    'url': token_hex(32),
+                    'password': token_hex(32),
+                    'users': {},
+                    'nodes': {},
+                    'subject': message['subject'],
+                    'counter': room_name,
+                    'user_list': None
+                }
+            rejoin = message.get('rejoin') and message['user'] in jitsi_rooms[room_name]['users']
+            jitsi_rooms[room_name]['users'][message['user']] = expires
+            if 'node' in message:
+                jitsi_rooms[room_name]['nodes'][message['user']] = message['node']
+            if not rejoin:
+                jitsi_room_counts[room_name]['enter'] += 1
+                logger.debug(f'Entering jitsi room for user/{message["user"]}/enter-jitsi-room')
+                await enter_user(message['user'], room_name)
+        changed()
+        schedule_user_list(room_name)
+
+    async def heartbeat_handler(topic, message):
+        room_name = topic.split('/')[1]
+        if room_name in jitsi_rooms and message['user'] in jitsi_rooms[room_name]['users']:
+            jitsi_rooms[room_name]['users'][message['user']] = time() + lease
+            if jitsi_rooms[room_name]['nodes'].get(message['user']) != message['node']:
+                jitsi_rooms[room_name]['nodes'][message['user']] = message['node']
+                changed()
+
+    async def leave_handler(topic, message):
+        room_name = topic.split('/')[1]
+        if room_name in jitsi_rooms:
+            await remove_user(room_name, message['user'], 'leave')
+
+    async def request_user_list_handler(topic, message):
+        schedule_user_list(topic.split('/')[1])
+
+    async def node_offline_handler(topic, message):
+        node_id = topic.split('/')[1]
+        for room_name, room in list(jitsi_rooms.items()):
+            for user_id, node in list(room['nodes'].items()):
+                if node == node_id and room_name in jitsi_rooms:
+                    await remove_user(room_name, user_id, 'expire')
+
+    async def sweep():
+        now = time()
+        for room_name, room in list(jitsi_rooms.items()):
+            for user_id, expires in list(room['users'].items()):
+                if expires < now and room_name in jitsi_rooms:
+                    logger.debug(f'Lease of user {user_id} in {room_name} expired')
+                    await remove_user(room_name, user_id, 'expire')
+
+    await mqtt.subscribe('jitsi-rooms/+/enter', enter_handler)
+    await mqtt.subscribe('jitsi-rooms/+/heartbeat', heartbeat_handler)
+    await mqtt.subscribe('jitsi-rooms/+/leave', leave_handler)
+    await mqtt.subscribe('jitsi-rooms/+/request-user-list', request_user_list_handler)
+    await mqtt.subscribe('server/+/offline', node_offline_handler)
+    PeriodicCallback(sweep, lease * 250).start()
+    logger.debug('Jitsi room state server started')
+
+
+async def room_presence_server(config, mqtt, avatars):
+    """Track the users and avatar locations in all rooms.
+
+    For each room, a sprite atlas of its users' small avatar images is maintained and published to
+    ``room/{room}/atlas`` whenever it changes, at most once per ``server.atlas_interval`` milliseconds, so that clients
+    can load all avatars in a room with a single request. Atlases are rendered in a thread and written to the
+    ``atlases`` directory below the avatar directory, which is served at ``server.prefixes.atlases``.
+    """
+    rooms = {}
+    atlases = {}
+    interval = config['server']['atlas_interval'] / 1000
+    atlas_directory = os.path.join(avatars.directory, 'atlases')
+    os.makedirs(atlas_directory, exist_ok=True)
+    for filename in os.listdir(atlas_directory):
+        os.unlink(os.path.join(atlas_directory, filename))
+    logger.debug('Room presence server starting up')
+
+    def schedule_atlas(room_name):
+        if room_name not in atlases:
+            atlases[room_name] = {
+                'atlas': RoomAtlas(avatars, atlas_directory, config['server']['prefixes']['atlases']),
+                'frames': None,
+                'timeout': None,
+                'rendering': False
+            }
+        if atlases[room_name]['timeout'] is None and not atlases[room_name]['rendering']:
+            atlases[room_name]['timeout'] = IOLoop.current().call_later(interval, publish_atlas, room_name)
+
+    def remove_atlas_files(filenames):
+        in_use = set([filename for atlas in atlases.values() for filename in atlas['atlas'].files])
+        for filename in set(filenames) - in_use:
+            try:
+                os.unlink(os.path.join(atlas_directory, filename))
+            except FileNotFoundError:
+                pass
+
+    def discard_atlas(room_name):
+        atlas = atlases.pop(room_name)
+        if atlas['timeout'] is not None:
+            IOLoop.current().remove_timeout(atlas['timeout'])
+        remove_atlas_files(atlas['atlas'].files)
+
+    async def publish_atlas(room_name):
+        atlas = atlases[room_name]
+        atlas['timeout'] = None
+        atlas['rendering'] = True
+        users = set([avatar['user']['avatar'] for avatar in rooms.get(room_name, {}).values()])
+        try:
+            frames = await IOLoop.current().run_in_executor(None, atlas['atlas'].update, users)
+        except Exception as e:
+            logger.error(f'Failed to render the avatar atlas for {room_name}: {e}')
+            frames = atlas['frames']
+        if room_name not in rooms:
+            discard_atlas(room_name)
+            return
+        if len(atlas['atlas'].files) > 2:
+            previous = atlas['atlas'].files[:-2]
+            atlas['atlas'].files = atlas['atlas'].files[-2:]
+            remove_atlas_files(previous)
+        try:
+            if frames != atlas['frames']:
+                atlas['frames'] = frames
+                await mqtt.publish(f'room/{room_name}/atlas',
+                                   payload=codec.dumps({'room': room_name, 'atlas': frames}))
+        finally:
+            atlas['rendering'] = False
+        if room_name not in rooms:
+            discard_atlas(room_name)
+        elif users != set([avatar['user']['avatar'] for avatar in rooms[room_name].values()]):
+            schedule_atlas(room_name)
+
+    async def enter_handler(topic, message):
+        room_name = topic.split('/')[1]
+        if room_name not in rooms:
+            rooms[room_name] = {}
+        if message['user']['id'] in rooms[room_name]:
+            if rooms[room_name][message['user']['id']]['user']['avatar'] != message['user']['avatar']:
+                schedule_atlas(room_name)
+            rooms[room_name][message['user']['id']].update(message)
+        else:
+            rooms[room_name][message['user']['id']] = {
+                'user': message['user'],
+                'node': message['node'],
+                'x': None,
+                'y': None
+            }
+            schedule_atlas(room_name)
+
+    async def set_avatar_location_handler(topic, message):
+        room_name = topic.split('/')[1]
+        user_id, x, y = message
+        if room_name in rooms and user_id in rooms[room_name]:
+            rooms[room_name][user_id]['x'] = x
+            rooms[room_name][user_id]['y'] = y
+
+    async def leave_handler(topic, message):
+        room_name = topic.split('/')[1]
+        if room_name in rooms:
+            if message['user'] in rooms[room_name]:
+                del rooms[room_name][message['user']]
+                schedule_atlas(room_name)
+            if len(rooms[room_name]) == 0:
+                del rooms[room_name]
+
+    async def request_snapshot_handler(topic, message):
+        room_name = topic.split('/')[1]
+        avatars = []
+        if room_name in rooms:
+            avatars = [{
+                'user': avatar['user'],
+                'x': avatar['x'],
+                'y': avatar['y']
+            } for user_id, avatar in rooms[room_name].items() if user_id != message['user']]
+        await mqtt.publish(f'user/{message["user"]}/room-snapshot',
+                           payload=codec.dumps({
+                               'room': room_name,
+                               'avatars': avatars,
+                               'atlas': atlases[room_name]['frames'] if room_name in atlases else None
+                           }))
+
+    async def node_offline_handler(topic, message):
+        node_id = topic.split('/')[1]
+        for room_name, avatars in list(rooms.items()):
+            for user_id, avatar in list(avatars.items()):
+                if avatar.get('node') == node_id:
+                    logger.debug(f'Evicting user {user_id} from {room_name}')
+                    await mqtt.publish(f'room/{room_name}/leave',
+                                       payload=codec.dumps({
+                                           'user': user_id,
+                                           'room': room_name
+                                       }))
+
+    await mqtt.subscribe('room/+/enter', enter_handler)
+    await mqtt.subscribe('room/+/set-avatar-location', set_avatar_location_handler)
+    await mqtt.subscribe('room/+/leave', leave_handler)
+    await mqtt.subscribe('room/+/request-snapshot', request_snapshot_handler)
+    await mqtt.subscribe('server/+/offline', node_offline_handler)
+    logger.debug('Room presence server started')
 
 
 def create_application(config):
+    sessionmaker = create_sessionmaker(setup_engine(config))
+    mqtt = MQTTClient(config['mosquitto'])
+    IOLoop.current().add_callback(mqtt.run)
+    movement = MovementAggregator(mqtt, config['server']['movement_tick'], config['rooms'])
+    movement.start()
+    images = ImageProcessor(config['images']['workers'], config['images']['concurrency'],
+                            config['images']['queue_size'], config['images']['max_resolution'])
+    mail = MailQueue(config['email'])
+    IOLoop.current().add_callback(mail.start)
+    user_cache = UserCache(mqtt, config['server']['user_cache_size'], config['server']['user_cache_ttl'])
+    IOLoop.current().add_callback(user_cache.start)
+    sessions = SessionStore(mqtt, config['server']['session_grace'])
+    IOLoop.current().add_callback(sessions.start)
+    avatars = AvatarStore(config['storage']['avatars'])
+    IOLoop.current().add_callback(avatars.start, mqtt)
+    maps = MapIndex(config)
+    atlas_path = urlparse(config['server']['prefixes']['atlases']).path.rstrip('/')
+    variants = VariantCache(avatars, images, config['images']['variant_sizes'],
+                            config['images']['variant_cache_size'])
     app = Application(
         [
-            (r'/api', ApiHandler, {'config': config}),
+            (r'/api', ApiHandler, {'config': config,
+                                   'config_frames': ConfigFrames(config),
+                                   'schedule': ScheduleStore(config['schedule']),
+                                   'sessionmaker': sessionmaker,
+                                   'mqtt': mqtt,
+                                   'movement': movement,
+                                   'images': images,
+                                   'avatars': avatars,
+                                   'mail': mail,
+                                   'user_cache': user_cache,
+                                   'sessions': sessions,
+                                   'maps': maps}),
+            (r'/api/avatar', AvatarUploadHandler, {'config': config,
+                                                   'sessionmaker': sessionmaker,
+                                                   'mqtt': mqtt,
+                                                   'images': images,
+                                                   'avatars': avatars,
+                                                   'user_cache': user_cache}),
+            (r'/api/avatars/(.*)', AvatarVariantHandler, {'variants': variants}),
+            (rf'{re.escape(atlas_path)}/([0-9a-f]{{32}}\.png)', AtlasHandler,
+             {'path': os.path.join(avatars.directory, 'atlases')}),
+            (r'/api/maps/([a-zA-Z0-9_\-]+)', MapHandler, {'maps': maps}),
         ],
-        debug=True,
-        websocket_max_message_size=14680064)
+        debug=config['server']['debug'],
+        websocket_max_message_size=65536,
+        websocket_ping_interval=config['server']['ping_interval'],
+        mqtt=mqtt,
+        images=images,
+        avatars=avatars,
+        mail=mail)
     return app
 
 
-def start_web_server(config):
+def start_web_server(config, sockets):
     logger.info('Web server starting up')
     app = create_application(config)
-    return app.listen(6543, '0.0.0.0')
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+    return app
 
 
 def start_server(config):
+    """Start the server, forking into ``server.workers`` processes (one per CPU if 0) that share the socket.
+
+    The shared jitsi room and room presence state servers only run in the first worker.
+    """
     logger.info('Server starting up')
-    if 'jitsi' in config and 'main' in config['jitsi'] and config['jitsi']['main']:
-        IOLoop.current().add_callback(jitsi_room_state_server, config)
-    start_web_server(config)
-    IOLoop.current().start()
+    sockets = bind_sockets(config['server']['port'], config['server']['address'])
+    task_id = None
+    if config['server']['workers'] != 1:
+        if config['server']['debug']:
+            logger.warning('Debug mode is not supported with multiple workers and has been disabled')
+            config['server']['debug'] = False
+        task_id = fork_processes(config['server']['workers'] if config['server']['workers'] > 0 else None)
+    app = start_web_server(config, sockets)
+    metrics.start_metrics_log(config['server']['metrics_interval'])
+    if task_id is None or task_id == 0:
+        if 'jitsi' in config and 'main' in config['jitsi'] and config['jitsi']['main']:
+            IOLoop.current().add_callback(jitsi_room_state_server, config, app.settings['mqtt'])
+        if config['server']['main']:
+            IOLoop.current().add_callback(room_presence_server, config, app.settings['mqtt'], app.settings['avatars'])
+    try:
+        IOLoop.current().start()
+    except KeyboardInterrupt:
+        logger.info('Server shutting down')
+    finally:
+        IOLoop.current().run_sync(app.settings['mail'].stop)
+        IOLoop.current().run_sync(app.settings['mqtt'].disconnect)
+        IOLoop.current().run_sync(dispose_engines)
+        app.settings['images'].shutdown()
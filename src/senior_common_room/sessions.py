@@ -0,0 +1,109 @@
+import asyncio
+import logging
+
+from tornado.ioloop import IOLoop
+from typing import Optional, Tuple
+
+from . import codec
+from .mqtt import MQTTClient
+
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore():
+    """The resumable sessions of the handlers in this process.
+
+    When an authenticated connection closes, its handler is parked for ``grace`` seconds instead of being torn down.
+    It stays in its room and Jitsi room, keeps its MQTT subscriptions and buffers the messages it would have sent to
+    the client. A connection that authenticates as the same user with the session id within the grace period takes
+    over the handler's state, whether it is still open, parked in this process, or parked in another process, in
+    which case it is claimed over MQTT.
+    """
+
+    def __init__(self, mqtt: MQTTClient, grace: int, claim_timeout: float = 0.5):
+        self.mqtt = mqtt
+        self.grace = grace
+        self.claim_timeout = claim_timeout
+        self.handlers = {}
+        self.timeouts = {}
+        self.claims = {}
+
+    async def start(self):
+        if self.grace > 0:
+            await self.mqtt.subscribe('sessions/+/claim', self.on_claim)
+            await self.mqtt.subscribe('sessions/+/state', self.on_state)
+
+    def register(self, handler):
+        self.handlers[handler.session_id] = handler
+
+    def discard(self, handler):
+        if handler.session_id and self.handlers.get(handler.session_id) is handler:
+            del self.handlers[handler.session_id]
+            if handler.session_id in self.timeouts:
+                IOLoop.current().remove_timeout(self.timeouts.pop(handler.session_id))
+        handler.session_id = None
+
+    def park(self, handler) -> bool:
+        """Park the closed handler until it is resumed or the grace period ends. Return whether it was parked."""
+        if self.grace > 0 and handler.session_id and self.handlers.get(handler.session_id) is handler:
+            handler.parked = True
+            self.timeouts[handler.session_id] = IOLoop.current().call_later(self.grace, self.expire,
+                                                                           handler.session_id)
+            return True
+        return False
+
+    def expire(self, session_id: str):
+        if session_id in self.handlers:
+            handler = self.handlers[session_id]
+            logger.debug(f'Session {session_id} expired')
+            self.discard(handler)
+            handler.teardown()
+
+    def take(self, session_id: str, user_id: int):
+        handler = self.handlers.get(session_id)
+        if handler is not None and handler.user.id == user_id:
+            del self.handlers[session_id]
+            if session_id in self.timeouts:
+                IOLoop.current().remove_timeout(self.timeouts.pop(session_id))
+            return handler
+        return None
+
+    async def claim(self, session_id: Optional[str], user_id: int) -> Tuple[Optional[object], Optional[dict]]:
+        """Find the session for the user. Returns the handler, if it is in this process, and the session state.
+
+        The handler that is returned still has to be detached once its state has been taken over.
+        """
+        if self.grace <= 0 or not session_id:
+            return None, None
+        handler = self.take(session_id, user_id)
+        if handler is not None:
+            return handler, handler.session_state()
+        future = asyncio.get_event_loop().create_future()
+        self.claims[session_id] = future
+        try:
+            await self.mqtt.publish(f'sessions/{session_id}/claim',
+                                    payload=codec.dumps({
+                                        'user': user_id,
+                                        'node': self.mqtt.node_id
+                                    }))
+            return None, await asyncio.wait_for(future, self.claim_timeout)
+        except asyncio.TimeoutError:
+            return None, None
+        finally:
+            del self.claims[session_id]
+
+    async def on_claim(self, topic, message):
+        session_id = topic.split('/')[1]
+        if message['node'] != self.mqtt.node_id:
+            handler = self.take(session_id, message['user'])
+            if handler is not None:
+                logger.debug(f'Handing session {session_id} over to {message["node"]}')
+                state = handler.session_state()
+                await handler.detach_session()
+                await self.mqtt.publish(f'sessions/{session_id}/state', payload=codec.dumps(state))
+
+    async def on_state(self, topic, message):
+        session_id = topic.split('/')[1]
+        if session_id in self.claims and not self.claims[session_id].done():
+            self.claims[session_id].set_result(message)